@@ -0,0 +1,69 @@
+#!/usr/bin/python
+
+# debuglog - throughput of the debug message path of the broker
+# Copyright (C) 2012 Adrian Matoga
+#
+# bali-sdk is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# bali-sdk is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with bali-sdk.  If not, see <http://www.gnu.org/licenses/>.
+import os
+import sys
+import time
+import string
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+import broker
+
+def stream(nmsgs):
+	"""Build what the debug port of the phone sends when the app
+	logs nmsgs messages."""
+	return ''.join('\x1b\x02[%05d|12:34:56|App:0> frame %d drawn in %d ms)\x1b\x03' % (i % 100000, i, i % 17)
+		for i in xrange(nmsgs))
+
+def runPrint(data, out, readSize):
+	"""The loop printing one message at a time."""
+	bufs = dict((c, broker.ChannelBuffer()) for c in broker.SamsungWave._CHANNELS)
+	dec = broker.FrameDecoder(bufs)
+	for i in xrange(0, len(data), readSize):
+		dec.feed(data[i:i + readSize])
+		while bufs['debug']:
+			print >>out, string.strip(bufs['debug'].popleft())
+
+def runSink(data, out, readSize, **kwargs):
+	bufs = dict((c, broker.ChannelBuffer()) for c in broker.SamsungWave._CHANNELS)
+	dec = broker.FrameDecoder(bufs)
+	sink = broker.DebugSink(out, **kwargs)
+	for i in xrange(0, len(data), readSize):
+		dec.feed(data[i:i + readSize])
+		if bufs['debug']:
+			sink.add(bufs['debug'].popAll())
+	sink.flush()
+
+def main():
+	nmsgs = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+	data = stream(nmsgs)
+	out = open(os.devnull, 'w')
+	print '%d messages, %d bytes' % (nmsgs, len(data))
+	print '%-28s %10s %12s' % ('', 'seconds', 'messages/s')
+	for name, run in [
+			('print each message', lambda: runPrint(data, out, 4096)),
+			('sink', lambda: runSink(data, out, 4096)),
+			('sink, timestamps', lambda: runSink(data, out, 4096, timestamps = True)),
+			('sink, substring filter', lambda: runSink(data, out, 4096, substring = 'in 3 ms')),
+			('sink, regex filter', lambda: runSink(data, out, 4096, pattern = 'in 1[0-9] ms'))]:
+		t = time.time()
+		run()
+		t = time.time() - t
+		print '%-28s %10.3f %12.0f' % (name, t, nmsgs / t)
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,69 @@
+#!/usr/bin/python
+
+# decoder - micro-benchmark for the broker's frame decoder
+# Copyright (C) 2012 Adrian Matoga
+#
+# bali-sdk is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# bali-sdk is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with bali-sdk.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import struct
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+import broker
+
+def frame(cmd, payload):
+	return '\x7f' + struct.pack('<HB', len(payload), cmd) + payload + '\x7e'
+
+def session(nbytes):
+	"""Build a stream resembling what the phone sends during install:
+	mostly file command responses, mixed with status frames, AT lines
+	and debug blocks."""
+	parts = [
+		'AT+CGMM\r\n', 'GT-S8500\r\n', 'OK\r\n',
+		frame(4, '\x04[1600:1601]'),
+		frame(4, '01234|12:34:56|PHONESTATUS:0> errType=0'),
+		frame(4, '01235|12:34:57|PROCESSMGR:0> terminated'),
+		frame(0x30, '\x30\xe2' + struct.pack('<iHH', 0, 3, 6) + '\0' * 0x5dc),
+		'\x1b\x02[' + 'debug message from the app, line 1\n' * 4 + ')\x1b\x03',
+		]
+	unit = ''.join(parts)
+	return unit * (nbytes // len(unit) + 1)
+
+def run(data, readSize):
+	bufs = { 'AT+': [], 'raw': [], 'PHONESTATUS': [], 'PROCESSMGR': [], 'debug': [] }
+	dec = broker.FrameDecoder(bufs)
+	t = time.time()
+	for i in xrange(0, len(data), readSize):
+		dec.feed(data[i:i + readSize])
+	t = time.time() - t
+	return t, sum(len(b) for b in bufs.values())
+
+def main():
+	nbytes = int(sys.argv[1]) if len(sys.argv) > 1 else 16 << 20
+	data = session(nbytes)
+	print '%d bytes of input' % len(data)
+	print '%10s %10s %10s %10s' % ('read size', 'seconds', 'MB/s', 'messages')
+	for readSize in [1, 64, 512, 4096, 65536]:
+		if readSize == 1 and len(data) > 1 << 20:
+			t, n = run(data[:1 << 20], readSize)
+			t *= float(len(data)) / (1 << 20)
+			n = n * len(data) >> 20
+		else:
+			t, n = run(data, readSize)
+		print '%10d %10.3f %10.2f %10d' % (readSize, t, len(data) / t / 1e6, n)
+
+if __name__ == "__main__":
+	main()
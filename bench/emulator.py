@@ -0,0 +1,393 @@
+#!/usr/bin/python
+
+# emulator - stand-in for a bada phone, talking to the broker over ptys
+# Copyright (C) 2012 Adrian Matoga
+#
+# bali-sdk is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# bali-sdk is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with bali-sdk.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import tty
+import time
+import errno
+import heapq
+import select
+import random
+import struct
+import getopt
+import threading
+
+_FILE_OPEN = 0x00
+_FILE_CLOSE = 0x01
+_FILE_WRITE = 0x02
+_FILE_READ = 0x03
+_FILE_DELETE = 0x04
+_DIR_CREATE = 0x05
+_DIR_DELETE = 0x06
+_DIR_OPEN = 0x07
+_DIR_READ = 0x08
+_DIR_CLOSE = 0x09
+
+def frame(cmd, payload):
+	return '\x7f' + struct.pack('<HB', len(payload), cmd) + payload + '\x7e'
+
+class Emulator:
+	"""Pretends to be a phone connected through two pseudo-terminals:
+	the command port (self.port) and the debug port (self.debugPort).
+	It keeps the phone's file system in memory.
+
+	The link is modelled with a one-way latency in seconds and a bandwidth
+	in bytes per second (None for unlimited). A fraction errorRate of file
+	writes fails with an error code, and a fraction dropRate of file
+	commands is lost without a response. replug() simulates the phone
+	being disconnected and connected again."""
+
+	def __init__(self, latency = 0.0, bandwidth = None, errorRate = 0.0, dropRate = 0.0,
+		model = 'GT-S8500', serial = '350000000000000', userMem = 64 << 20,
+		chunkSize = 0x5dc, canAppend = True, seed = None):
+		self.latency = latency
+		self.bandwidth = bandwidth
+		self.errorRate = errorRate
+		self.dropRate = dropRate
+		self.model = model
+		self.serial = serial
+		self.userMem = userMem
+		self.chunkSize = chunkSize
+		self.canAppend = canAppend
+		self.dirs = set([''])
+		self.files = {}
+		self.nframes = 0
+		self._random = random.Random(seed)
+		self._openFile = None
+		self._readPos = 0
+		self._listing = None
+		self._seq = 0
+		self._pty = {}
+		self._linkIn = {}
+		self._linkOut = {}
+		self._outq = []
+		self._cond = threading.Condition()
+		self._running = False
+		self._threads = []
+		self._openPorts()
+
+	def _openPorts(self):
+		for name in ['cmd', 'debug']:
+			master, slave = os.openpty()
+			# no echo or line discipline until the broker opens the port
+			tty.setraw(slave)
+			self._pty[name] = (master, slave)
+			self._linkIn[name] = 0
+			self._linkOut[name] = 0
+		self.port = os.ttyname(self._pty['cmd'][1])
+		self.debugPort = os.ttyname(self._pty['debug'][1])
+
+	def _closePorts(self):
+		for master, slave in self._pty.values():
+			os.close(slave)
+			os.close(master)
+
+	def replug(self):
+		"""Drop the connection and reappear under new pty names."""
+		self.stop()
+		self._outq = []
+		self._openFile = None
+		self._openPorts()
+		self.start()
+
+	def start(self):
+		self._running = True
+		self._threads = [
+			threading.Thread(target = self._reader, args = ('cmd',)),
+			threading.Thread(target = self._reader, args = ('debug',)),
+			threading.Thread(target = self._writer) ]
+		for t in self._threads:
+			t.daemon = True
+			t.start()
+
+	def stop(self):
+		with self._cond:
+			self._running = False
+			self._cond.notify()
+		for t in self._threads:
+			t.join()
+		self._closePorts()
+
+	def _transferTime(self, n):
+		if not self.bandwidth:
+			return 0.0
+		return float(n) / self.bandwidth
+
+	def _reply(self, port, data, arrival):
+		"""Queue data to be written to port once a request that arrived
+		at time arrival has been processed and the reply got through the link."""
+		with self._cond:
+			due = max(arrival + self.latency, self._linkOut[port]) + self._transferTime(len(data))
+			self._linkOut[port] = due
+			self._seq += 1
+			heapq.heappush(self._outq, (due, self._seq, port, data))
+			self._cond.notify()
+
+	def _writer(self):
+		while True:
+			with self._cond:
+				while self._running and not self._outq:
+					self._cond.wait()
+				if not self._running:
+					return
+				due, seq, port, data = heapq.heappop(self._outq)
+			# replies are queued in almost the same order as they become due,
+			# so a plain sleep is precise enough, unlike a timed wait
+			delay = due - time.time()
+			if delay > 0:
+				time.sleep(delay)
+			try:
+				os.write(self._pty[port][0], data)
+			except OSError:
+				return
+
+	def _reader(self, port):
+		master = self._pty[port][0]
+		buf = ''
+		while self._running:
+			try:
+				# wake up now and then to check if we've been stopped
+				if not select.select([master], [], [], 0.1)[0]:
+					continue
+				data = os.read(master, 65536)
+			except (OSError, select.error), err:
+				if err.args[0] == errno.EINTR:
+					continue
+				return
+			if not data:
+				return
+			buf += data
+			while buf:
+				if buf[0] == '\x7f':
+					if len(buf) < 3:
+						break
+					n = struct.unpack('<H', buf[1:3])[0] + 5
+					if len(buf) < n:
+						break
+					msg, buf = buf[:n], buf[n:]
+				else:
+					e = buf.find('\r')
+					if e < 0:
+						break
+					msg, buf = buf[:e + 1], buf[e + 1:]
+					if buf[:1] == '\n':
+						buf = buf[1:]
+				arrival = max(time.time(), self._linkIn[port]) + self._transferTime(len(msg))
+				self._linkIn[port] = arrival
+				if port == 'cmd':
+					self._request(msg, arrival)
+
+	def _request(self, msg, arrival):
+		self.nframes += 1
+		if msg[0] != '\x7f':
+			self._atCommand(msg.strip(), arrival)
+			return
+		if msg[-1] != '\x7e':
+			return
+		cmd = ord(msg[3])
+		payload = msg[4:-1]
+		if cmd == 0x30:
+			if self._random.random() < self.dropRate:
+				return
+			op = ord(payload[0])
+			err, status, tail = self._fileCommand(op, payload[2:])
+			self._reply('cmd', frame(0x30, chr(op | 0xe0) + struct.pack('<iHH', err, 3, status) + tail), arrival)
+		elif cmd == 4:
+			self._textCommand(payload, arrival)
+
+	def _atCommand(self, command, arrival):
+		if command == 'AT+CGMM':
+			ans = [self.model]
+		elif command == 'AT+CGSN':
+			ans = [self.serial]
+		elif command == 'AT+USERMEM':
+			ans = ['+USERMEM:%dk' % (self.userMem >> 10)]
+		elif command == 'AT+LCDINFO':
+			ans = ['+LCDINFO: 240, 400']
+		else:
+			self._reply('cmd', command + '\r\n\r\nERROR\r\n', arrival)
+			return
+		self._reply('cmd', command + '\r\n' + ''.join('\r\n%s\r\n' % a for a in ans) + '\r\nOK\r\n', arrival)
+
+	def _status(self, channel, text, arrival):
+		self._seq += 1
+		self._reply('cmd', frame(4, '%05d|%s|%s:0> %s' % (
+			self._seq % 100000, time.strftime('%H:%M:%S'), channel, text)), arrival)
+
+	def _textCommand(self, text, arrival):
+		mo = text.split(' ')
+		if mo[0] == '[1600:1601]GetAppInstallCondition':
+			free = self.userMem - sum(len(f) for f in self.files.values())
+			self._status('PHONESTATUS', 'errType=%d' % (0 if int(mo[2]) <= free else 2), arrival)
+		elif mo[0] == '[1600:1601]TerminateProcessEx':
+			self._status('PROCESSMGR', 'TerminateProcessEx %s' % mo[1], arrival)
+		elif mo[0] == '[1600:1601]AppPkgInstall':
+			ok = (mo[1] + '/Info/manifest.xml') in self.files
+			self._status('PHONESTATUS', 'errType=%d' % (0 if ok else 1), arrival)
+		elif text.startswith('[1400:1400]'):
+			for i in range(10):
+				self._reply('debug', '\x1b\x02[' + 'emulator: running %s (%d)' % (text[11:].split(',')[0], i) + ')\x1b\x03', arrival)
+
+	def _parent(self, name):
+		return name.rsplit('/', 1)[0]
+
+	def _fileCommand(self, op, arg):
+		"""Perform file command op and return a tuple (error, status, tail)."""
+		if op == _FILE_OPEN:
+			if arg[:1] == '/':
+				name = arg.split('\0')[0]
+				if not name in self.files:
+					return -1, 6, ''
+				self._openFile = name
+				self._readPos = 0
+			else:
+				mode = struct.unpack('<I', arg[:4])[0]
+				name = arg[4:].split('\0')[0]
+				if not self._parent(name) in self.dirs:
+					return -1, 6, ''
+				if mode == 0x0a:
+					if not self.canAppend or not name in self.files:
+						return -1, 6, ''
+				else:
+					self.files[name] = bytearray()
+				self._openFile = name
+			return 0, 6, ''
+		elif op == _FILE_CLOSE:
+			self._openFile = None
+			return 0, 6, ''
+		elif op == _FILE_WRITE:
+			if self._openFile is None:
+				return -1, 6, ''
+			if self._random.random() < self.errorRate:
+				return -1, 6, ''
+			if len(arg) > self.chunkSize:
+				return -1, 6, ''
+			self.files[self._openFile] += arg
+			return 0, 6, ''
+		elif op == _FILE_READ:
+			if self._openFile is None:
+				return -1, 6, ''
+			data = self.files[self._openFile][self._readPos:self._readPos + self.chunkSize]
+			self._readPos += len(data)
+			return 0, 6, str(data)
+		elif op == _FILE_DELETE:
+			name = arg.split('\0')[0]
+			if not name in self.files:
+				return -1, 6, ''
+			del self.files[name]
+			return 0, 6, ''
+		elif op == _DIR_CREATE:
+			name = arg.split('\0')[0]
+			if not self._parent(name) in self.dirs:
+				return -1, 13, ''
+			self.dirs.add(name)
+			return 0, 13, ''
+		elif op == _DIR_DELETE:
+			name = arg.split('\0')[0]
+			if not name in self.dirs or self._children(name):
+				return -1, 13, ''
+			self.dirs.discard(name)
+			return 0, 13, ''
+		elif op == _DIR_OPEN:
+			name = arg.split('\0')[0]
+			if not name in self.dirs:
+				return -1, 13, ''
+			self._listing = [(2, 0, '.'), (2, 0, '..')] + self._children(name)
+			return 0, 13, ''
+		elif op == _DIR_READ:
+			if self._listing:
+				attr, size, name = self._listing.pop(0)
+			else:
+				attr, size, name = 0, 0, ''
+			return 0, 13, struct.pack('<ii', attr, size) + '\0' * 28 + name + '\0'
+		elif op == _DIR_CLOSE:
+			self._listing = None
+			return 0, 13, ''
+		return -1, 0, ''
+
+	def _children(self, name):
+		prefix = name + '/'
+		ents = []
+		for d in self.dirs:
+			if d.startswith(prefix) and not '/' in d[len(prefix):]:
+				ents.append((2, 0, d[len(prefix):]))
+		for f, data in self.files.items():
+			if f.startswith(prefix) and not '/' in f[len(prefix):]:
+				ents.append((1, len(data), f[len(prefix):]))
+		return sorted(ents)
+
+def usage():
+	print '''Usage:
+ {0} [options]
+
+Runs until interrupted, and prints the names of the ptys to pass to
+bada-broker with --port and --debug-port.
+
+Options:
+ -l,  --latency=ms       One-way latency of the link (default: 0).
+ -b,  --bandwidth=kB/s   Bandwidth of the link (default: unlimited).
+ -e,  --error-rate=p     Fraction of file writes that fail (default: 0).
+ -x,  --drop-rate=p      Fraction of file commands that are never
+                         answered (default: 0).
+ -m,  --model=name       Model name reported by AT+CGMM.
+ -c,  --chunk-size=n     Largest file write accepted (default: 1500).
+ -u,  --user-mem=kB      User memory size (default: 65536).'''.format(sys.argv[0])
+
+def main():
+	try:
+		opts, args = getopt.getopt(
+			sys.argv[1:],
+			"hl:b:e:x:m:c:u:",
+			["help", "latency=", "bandwidth=", "error-rate=", "drop-rate=", "model=", "chunk-size=", "user-mem="])
+	except getopt.GetoptError, err:
+		sys.stderr.write('%s: %s\n' % (sys.argv[0], str(err)))
+		sys.exit(2)
+	kwargs = {}
+	for o, a in opts:
+		if o in ('-h', '--help'):
+			usage()
+			sys.exit()
+		elif o in ('-l', '--latency'):
+			kwargs['latency'] = float(a) / 1000
+		elif o in ('-b', '--bandwidth'):
+			kwargs['bandwidth'] = float(a) * 1024
+		elif o in ('-e', '--error-rate'):
+			kwargs['errorRate'] = float(a)
+		elif o in ('-x', '--drop-rate'):
+			kwargs['dropRate'] = float(a)
+		elif o in ('-m', '--model'):
+			kwargs['model'] = a
+		elif o in ('-c', '--chunk-size'):
+			kwargs['chunkSize'] = int(a, 0)
+		elif o in ('-u', '--user-mem'):
+			kwargs['userMem'] = int(a) * 1024
+	emu = Emulator(**kwargs)
+	emu.start()
+	print 'command port: %s' % emu.port
+	print 'debug port:   %s' % emu.debugPort
+	sys.stdout.flush()
+	try:
+		while True:
+			time.sleep(1)
+	except KeyboardInterrupt:
+		pass
+	emu.stop()
+
+if __name__ == "__main__":
+	main()
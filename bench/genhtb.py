@@ -0,0 +1,61 @@
+#!/usr/bin/python
+
+# genhtb - speed of the hashtable generation
+# Copyright (C) 2012 Adrian Matoga
+#
+# bali-sdk is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# bali-sdk is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with bali-sdk.  If not, see <http://www.gnu.org/licenses/>.
+import os
+import sys
+import time
+import hashlib
+import tempfile
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+import genhtb
+
+def oldDigests(exeFileName):
+	"""The loop genhtb used to run: read a page, hash it, write the digest."""
+	out = open(os.devnull, 'w')
+	inf = open(exeFileName, 'rb')
+	while True:
+		piece = inf.read(4096)
+		if not piece:
+			break
+		s = hashlib.sha1()
+		s.update(piece)
+		out.write(s.digest())
+
+def main():
+	size = int(sys.argv[1]) << 20 if len(sys.argv) > 1 else 128 << 20
+	fd, exe = tempfile.mkstemp(prefix = 'bada-bench-', suffix = '.exe')
+	try:
+		for i in xrange(0, size, 1 << 20):
+			os.write(fd, os.urandom(min(1 << 20, size - i)))
+		os.close(fd)
+		print '%d MB executable, %d cores' % (size >> 20, multiprocessing.cpu_count())
+		print '%-24s %10s %10s' % ('', 'seconds', 'MB/s')
+		runs = [('read, hash, write', lambda: oldDigests(exe))]
+		for n in sorted(set([1, 2, multiprocessing.cpu_count()])):
+			runs.append(('mmap, %d processes' % n, lambda n = n: genhtb.pageDigests(exe, n)))
+		for name, run in runs:
+			t = time.time()
+			run()
+			t = time.time() - t
+			print '%-24s %10.3f %10.1f' % (name, t, size / t / 1e6)
+	finally:
+		os.unlink(exe)
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,245 @@
+#!/usr/bin/python
+
+# replay - feeds the data captured from a phone back to the broker
+# Copyright (C) 2012 Adrian Matoga
+#
+# bali-sdk is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# bali-sdk is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with bali-sdk.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import time
+import getopt
+import threading
+import collections
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+import broker
+
+class Clock:
+	"""Tells when the data recorded at time t is due to be read: at the
+	same time since the start of the replay as it was since the start of
+	the capture, or at once if realTime is False. Nothing is due
+	before start() is called, which sets started."""
+	def __init__(self, t0, realTime):
+		self._t0 = t0
+		self._realTime = realTime
+		self._start = None
+		self.started = threading.Event()
+
+	def start(self):
+		self._start = time.time()
+		self.started.set()
+
+	def due(self, t):
+		if self._start is None:
+			return None
+		if not self._realTime:
+			return self._start
+		return self._start + t - self._t0
+
+class ReplayPort:
+	"""Stands in for serial.Serial, returning the data captured as read
+	from one port of the phone, one recorded read at a time, so that the
+	broker sees the data in the same pieces. Whatever is written to it
+	is discarded. done is set when the reads have run out."""
+	def __init__(self, reads, clock):
+		self._reads = collections.deque(reads)
+		self._clock = clock
+		self.timeout = 1
+		self.done = threading.Event()
+
+	def inWaiting(self):
+		if self._reads:
+			due = self._clock.due(self._reads[0][0])
+			if due is not None and due <= time.time():
+				return len(self._reads[0][1])
+		return 0
+
+	def read(self, n = 1):
+		if not self._clock.started.wait(self.timeout):
+			return ''
+		if not self._reads:
+			# the broker has decoded all that has been read
+			self.done.set()
+			time.sleep(self.timeout)
+			return ''
+		wait = self._clock.due(self._reads[0][0]) - time.time()
+		if wait > self.timeout:
+			time.sleep(self.timeout)
+			return ''
+		if wait > 0:
+			time.sleep(wait)
+		return self._reads.popleft()[1]
+
+	def write(self, data):
+		return len(data)
+
+	def flushInput(self):
+		pass
+
+	def flushOutput(self):
+		pass
+
+	def close(self):
+		pass
+
+class Recorder:
+	"""Stands in for a broker.Trace at the FULL level, keeping the time
+	each message has been decoded at, and the time the data completing
+	it has been read at."""
+	level = broker.Trace.FULL
+
+	def __init__(self):
+		self._lastRead = {}
+		self.decoded = collections.defaultdict(list)
+
+	def record(self, port, direction, data):
+		if direction == 0 and data:
+			self._lastRead[port] = time.time()
+
+	def message(self, port, channel, msg):
+		self.decoded[(broker.Trace.PORTS[port], channel)].append((self._lastRead[port], time.time()))
+
+def loadTrace(fileName):
+	"""Return tuple (reads, messages), where reads maps each port
+	to the list of tuples (time, data) read from it, and messages maps
+	tuples (port, channel) to the lists of messages decoded at capture."""
+	reads = dict((port, []) for port in broker.Trace.PORTS)
+	messages = collections.defaultdict(list)
+	for t, port, direction, data in broker.Trace.load(fileName):
+		if direction == 'read' and data:
+			reads[port].append((t, data))
+		elif direction == 'message':
+			messages[(port, data[0])].append(data[1])
+	return reads, messages
+
+def replay(reads, realTime):
+	"""Feed the reads to a SamsungWave and receive the messages from all
+	channels, as the broker does. Return tuple (seconds, received, recorder),
+	where received maps tuples (port, channel) to lists of tuples
+	(time received, message)."""
+	t0 = min([r[0][0] for r in reads.values() if r] or [0])
+	clock = Clock(t0, realTime)
+	ports = dict((port, ReplayPort(reads[port], clock)) for port in broker.Trace.PORTS)
+	recorder = Recorder()
+	# there are no more messages than bytes, so none is ever dropped
+	capacity = max(4096, sum(len(d) for r in reads.values() for t, d in r))
+	wave = broker.SamsungWave('cmd', 'debug', recorder, capacity,
+		openPort = lambda name, *args, **kwargs: ports[name])
+	received = collections.defaultdict(list)
+	def consumer(port, channel):
+		msgs = received[(port, channel)]
+		while True:
+			done = all(p.done.is_set() for p in ports.values())
+			got = wave._receiveAll(port, channel, 0 if done else 0.05)
+			now = time.time()
+			msgs.extend((now, msg) for msg in got)
+			if done and not got:
+				return
+	consumers = [threading.Thread(target = consumer, args = (port, channel))
+		for port in broker.Trace.PORTS for channel in wave._CHANNELS]
+	for t in consumers:
+		t.start()
+	start = time.time()
+	clock.start()
+	for t in consumers:
+		t.join()
+	end = max([msgs[-1][0] for msgs in received.values() if msgs] or [start])
+	wave.close()
+	return end - start, received, recorder
+
+def _percentiles(values):
+	if not values:
+		return '-'
+	values = sorted(values)
+	return 'p50 %.3f, p95 %.3f, max %.3f' % (values[len(values) // 2],
+		values[min(len(values) - 1, len(values) * 95 // 100)], values[-1])
+
+def check(fileName, realTime):
+	"""Replay a capture file, print the numbers and return True
+	if the messages are the same as those decoded at capture."""
+	reads, expected = loadTrace(fileName)
+	nbytes = sum(len(d) for r in reads.values() for t, d in r)
+	nreads = sum(len(r) for r in reads.values())
+	seconds, received, recorder = replay(reads, realTime)
+	nmessages = sum(len(msgs) for msgs in received.values())
+	decode = []
+	delivery = []
+	for key, times in recorder.decoded.items():
+		decode.extend((t - r) * 1000 for r, t in times)
+		delivery.extend((got[0] - r) * 1000 for (r, t), got in zip(times, received[key]))
+	print '%s: %d bytes in %d reads, %d messages, replayed in %.3f s (%.2f MB/s, %.0f messages/s)' % (
+		fileName, nbytes, nreads, nmessages, seconds, nbytes / max(seconds, 1e-9) / 1e6, nmessages / max(seconds, 1e-9))
+	print '  decode latency ms:   %s' % _percentiles(decode)
+	print '  delivery latency ms: %s' % _percentiles(delivery)
+	if not expected:
+		print '  no decoded messages in the capture, not checked'
+		return True
+	ok = True
+	for key in sorted(set(expected) | set(received)):
+		msgs = [msg for t, msg in received.get(key, [])]
+		want = expected.get(key, [])
+		if msgs == want:
+			continue
+		ok = False
+		i = 0
+		while i < min(len(msgs), len(want)) and msgs[i] == want[i]:
+			i += 1
+		print '  %s %s: %d messages, %d expected, first difference at %d:' % (key[0], key[1], len(msgs), len(want), i)
+		print '    got      %r' % (msgs[i] if i < len(msgs) else None,)
+		print '    expected %r' % (want[i] if i < len(want) else None,)
+	if ok:
+		print '  messages match the capture'
+	return ok
+
+def usage():
+	print '''{0} feeds the data read from the phone, as captured by bada-broker -t full,
+back to the broker, checks if it decodes the same messages from it as it did
+during the capture, and shows how fast it goes.
+
+Usage:
+ {0} [-r] trace_file...
+
+Options:
+ -r,  --real-time        Replay the data at the speed it has been received at,
+                         instead of as fast as possible.'''.format(sys.argv[0])
+
+def main():
+	try:
+		opts, args = getopt.getopt(sys.argv[1:], "hr", ["help", "real-time"])
+	except getopt.GetoptError, err:
+		sys.stderr.write('%s: %s\n' % (sys.argv[0], str(err)))
+		sys.exit(2)
+	realTime = False
+	for o, a in opts:
+		if o in ('-h', '--help'):
+			usage()
+			sys.exit()
+		elif o in ('-r', '--real-time'):
+			realTime = True
+	if not args:
+		usage()
+		sys.exit(2)
+	failed = 0
+	for fileName in args:
+		try:
+			if not check(fileName, realTime):
+				failed += 1
+		except (IOError, ValueError), err:
+			sys.stderr.write('%s: %s\n' % (sys.argv[0], str(err)))
+			failed += 1
+	sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,193 @@
+#!/usr/bin/python
+
+# sendpath - benchmark of building and writing the frames of a file upload
+# Copyright (C) 2012 Adrian Matoga
+#
+# bali-sdk is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# bali-sdk is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with bali-sdk.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import glob
+import time
+import ctypes
+import struct
+import getopt
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+import broker
+
+_FILE_WRITE = 0x02
+
+class NullPort:
+	"""Stands in for the serial port, writing to /dev/null."""
+	def __init__(self):
+		self.fd = os.open(os.devnull, os.O_WRONLY)
+
+	def write(self, data):
+		broker.writeAll(self.fd, data)
+
+	def close(self):
+		os.close(self.fd)
+
+def copyingPath(port, f, chunkSize):
+	"""The frames of a file upload as they used to be sent: each chunk
+	read into a new string, prefixed with the write command, framed by
+	concatenation and written as a string."""
+	n = 0
+	for chunk in broker.readByChunk(f, chunkSize):
+		payload = struct.pack("<BB", _FILE_WRITE, 0) + chunk
+		port.write('\x7f' + struct.pack('<HB', len(payload), 0x30) + payload + '\x7e')
+		n += 1
+	return n
+
+def frameWriterPath(port, f, chunkSize):
+	"""The same frames sent the way SamsungWave._sendFile does now."""
+	frames = broker.FrameWriter(lambda b: broker.writeAll(port.fd, b))
+	header = chr(_FILE_WRITE) + '\x00'
+	data = frames.payload[len(header):len(header) + chunkSize]
+	n = 0
+	while True:
+		k = f.readinto(data)
+		if not k:
+			break
+		frames.payload[:len(header)] = header
+		frames.send(0x30, len(header) + k)
+		n += 1
+	return n
+
+PATHS = [('copying', copyingPath), ('FrameWriter', frameWriterPath)]
+
+def run(pathName, fileName, chunkSize, repeat):
+	"""Return tuple (seconds per frame, number of frames)."""
+	path = dict(PATHS)[pathName]
+	port = NullPort()
+	best = None
+	try:
+		for i in range(repeat):
+			f = open(fileName, 'rb')
+			t = time.time()
+			n = path(port, f, chunkSize)
+			t = time.time() - t
+			f.close()
+			best = t if best is None else min(best, t)
+	finally:
+		port.close()
+	return best / n, n
+
+def mallocDebugLibrary():
+	for pattern in ['/lib*/libc_malloc_debug.so*', '/usr/lib*/libc_malloc_debug.so*',
+			'/lib/*/libc_malloc_debug.so*', '/usr/lib/*/libc_malloc_debug.so*']:
+		found = glob.glob(pattern)
+		if found:
+			return found[0]
+	return None
+
+def countMallocs(pathName, fileName, chunkSize):
+	"""Run the path once in a child process with glibc's malloc tracing on,
+	and return tuple (number of malloc calls, bytes requested). Only the
+	blocks too big for Python's own allocator show up, which includes
+	everything the size of a chunk."""
+	lib = mallocDebugLibrary()
+	if not lib:
+		return None
+	fd, traceName = tempfile.mkstemp(prefix = 'bada-mtrace')
+	os.close(fd)
+	try:
+		env = dict(os.environ, LD_PRELOAD = lib, MALLOC_TRACE = traceName)
+		subprocess.check_call([sys.executable, __file__, '--count', pathName, fileName, str(chunkSize)], env = env)
+		calls = 0
+		nbytes = 0
+		for line in open(traceName):
+			fields = line.split()
+			if len(fields) >= 2 and fields[-3:-2] in (['+'], ['>']):
+				calls += 1
+				nbytes += int(fields[-1], 16)
+		return calls, nbytes
+	finally:
+		os.unlink(traceName)
+
+def countChild(pathName, fileName, chunkSize):
+	# the working mtrace is only exported by libc_malloc_debug.so under
+	# its old symbol version, so dlsym would find the stub in libc.so
+	libc = ctypes.CDLL(None)
+	libc.dlvsym.restype = ctypes.c_void_p
+	libc.dlvsym.argtypes = [ctypes.c_void_p, ctypes.c_char_p, ctypes.c_char_p]
+	handle = ctypes.CDLL(os.environ['LD_PRELOAD'])._handle
+	mtrace, muntrace = [ctypes.CFUNCTYPE(None)(libc.dlvsym(handle, name, 'GLIBC_2.2.5'))
+		for name in ('mtrace', 'muntrace')]
+	port = NullPort()
+	f = open(fileName, 'rb')
+	path = dict(PATHS)[pathName]
+	mtrace()
+	path(port, f, chunkSize)
+	muntrace()
+
+def usage():
+	print '''Usage:
+ {0} [options]
+
+Options:
+ -s,  --size=kB          Size of the uploaded file (default: 4096).
+ -c,  --chunks=n,...     Chunk sizes to compare (default: 1500,32768).
+ -n,  --repeat=n         Number of repetitions, the best one counts (default: 5).
+ -m,  --malloc           Also count the malloc calls of each path
+                         (needs glibc's libc_malloc_debug.so).'''.format(sys.argv[0])
+
+def main():
+	if sys.argv[1:2] == ['--count']:
+		countChild(sys.argv[2], sys.argv[3], int(sys.argv[4]))
+		return
+	try:
+		opts, args = getopt.getopt(sys.argv[1:], "hs:c:n:m", ["help", "size=", "chunks=", "repeat=", "malloc"])
+	except getopt.GetoptError, err:
+		sys.stderr.write('%s: %s\n' % (sys.argv[0], str(err)))
+		sys.exit(2)
+	size = 4096 * 1024
+	chunks = [1500, 32768]
+	repeat = 5
+	malloc = False
+	for o, a in opts:
+		if o in ('-h', '--help'):
+			usage()
+			sys.exit()
+		elif o in ('-s', '--size'):
+			size = int(a) * 1024
+		elif o in ('-c', '--chunks'):
+			chunks = [int(c, 0) for c in a.split(',')]
+		elif o in ('-n', '--repeat'):
+			repeat = int(a)
+		elif o in ('-m', '--malloc'):
+			malloc = True
+	if malloc and not mallocDebugLibrary():
+		sys.stderr.write('%s: libc_malloc_debug.so not found, not counting malloc calls\n' % sys.argv[0])
+		malloc = False
+
+	fd, fileName = tempfile.mkstemp(prefix = 'bada-bench-')
+	try:
+		os.write(fd, os.urandom(size))
+		os.close(fd)
+		print '%-12s %7s %7s %10s %10s %12s %12s' % ('path', 'chunk', 'frames', 'us/frame', 'MB/s', 'mallocs/fr', 'bytes/frame')
+		for chunkSize in chunks:
+			for pathName, path in PATHS:
+				t, n = run(pathName, fileName, chunkSize, repeat)
+				m = countMallocs(pathName, fileName, chunkSize) if malloc else None
+				print '%-12s %7d %7d %10.2f %10.1f %12s %12s' % (pathName, chunkSize, n, t * 1e6,
+					size / (t * n) / 1e6, '%.2f' % (float(m[0]) / n) if m else '-', '%.0f' % (float(m[1]) / n) if m else '-')
+	finally:
+		os.unlink(fileName)
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,178 @@
+#!/usr/bin/python
+
+# transfer - benchmark of the broker talking to the emulated phone
+# Copyright (C) 2012 Adrian Matoga
+#
+# bali-sdk is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# bali-sdk is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with bali-sdk.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import time
+import shutil
+import getopt
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+import broker
+import catalog
+import emulator
+
+APPID = '93bt1p123e'
+APPNAME = 'hello'
+
+def makeApp(top, exeSize, nAssets, assetSize):
+	"""Create an application folder with random contents in top."""
+	for d in ['Bin', 'Data', 'Info', 'Res']:
+		os.makedirs(os.path.join(top, APPID, d))
+	def put(name, size):
+		f = open(os.path.join(top, APPID, name), 'wb')
+		f.write(os.urandom(size))
+		f.close()
+	put('Bin/%s.exe' % APPNAME, exeSize)
+	put('Info/%s.htb' % APPNAME, (exeSize + 4095) // 4096 * 20 + 64)
+	put('Info/manifest.xml', 600)
+	put('Info/application.xml', 700)
+	put('signature.xml', 3000)
+	for i in range(nAssets):
+		put('Res/asset%03d.png' % i, assetSize)
+
+def appSize(top):
+	return catalog.Catalog(os.path.join(top, 'catalog')).refresh(os.path.join(top, APPID))['size']
+
+class Quiet:
+	"""Swallow whatever the broker prints while it is being measured."""
+	def __enter__(self):
+		self._stdout = sys.stdout
+		sys.stdout = open(os.devnull, 'w')
+	def __exit__(self, *exc):
+		sys.stdout.close()
+		sys.stdout = self._stdout
+
+class Stats:
+	def __init__(self):
+		self.times = {}
+
+	def add(self, name, t):
+		self.times.setdefault(name, []).append(t)
+
+	def report(self):
+		print '%-32s %9s %9s %9s' % ('command', 'mean ms', 'min ms', 'max ms')
+		for name in sorted(self.times):
+			t = self.times[name]
+			print '%-32s %9.1f %9.1f %9.1f' % (name, 1000 * sum(t) / len(t), 1000 * min(t), 1000 * max(t))
+
+def run(stats, top, emu, window, repeat):
+	wave = broker.SamsungWave(emu.port, emu.debugPort)
+	wave.window = window
+	uploadTime = [0.0]
+	sendFile = wave.sendFile
+	def timedSendFile(*args, **kwargs):
+		t = time.time()
+		try:
+			return sendFile(*args, **kwargs)
+		finally:
+			uploadTime[0] += time.time() - t
+	wave.sendFile = timedSendFile
+	remoteDir = '/Osp/Applications/' + APPID
+	tag = ' (window %d)' % window
+	for i in range(repeat):
+		with Quiet():
+			t = time.time()
+			broker.install(wave, APPID, APPNAME + '.exe', True)
+			stats.add('install' + tag, time.time() - t)
+			t = time.time()
+			broker.install(wave, APPID, APPNAME + '.exe')
+			stats.add('install, unchanged' + tag, time.time() - t)
+			for d in ['', '/Res', '/Bin']:
+				t = time.time()
+				wave.listFiles(remoteDir + d)
+				stats.add('ls', time.time() - t)
+			t = time.time()
+			wave.deleteDirectory(remoteDir, True)
+			stats.add('rmdir -r', time.time() - t)
+	return uploadTime[0] / repeat
+
+def usage():
+	print '''Usage:
+ {0} [options]
+
+Options:
+ -l,  --latency=ms       One-way latency of the emulated link (default: 2).
+ -b,  --bandwidth=kB/s   Bandwidth of the emulated link (default: 1024).
+ -e,  --error-rate=p     Fraction of file writes that fail (default: 0).
+ -s,  --exe-size=kB      Size of the executable (default: 2048).
+ -a,  --assets=n         Number of 32 kB resource files (default: 16).
+ -w,  --windows=n,...    Pipelining windows to compare (default: 1,8).
+ -n,  --repeat=n         Number of repetitions (default: 3).'''.format(sys.argv[0])
+
+def main():
+	try:
+		opts, args = getopt.getopt(
+			sys.argv[1:],
+			"hl:b:e:s:a:w:n:",
+			["help", "latency=", "bandwidth=", "error-rate=", "exe-size=", "assets=", "windows=", "repeat="])
+	except getopt.GetoptError, err:
+		sys.stderr.write('%s: %s\n' % (sys.argv[0], str(err)))
+		sys.exit(2)
+	latency = 0.002
+	bandwidth = 1024 * 1024
+	errorRate = 0.0
+	exeSize = 2048 * 1024
+	nAssets = 16
+	windows = [1, 8]
+	repeat = 3
+	for o, a in opts:
+		if o in ('-h', '--help'):
+			usage()
+			sys.exit()
+		elif o in ('-l', '--latency'):
+			latency = float(a) / 1000
+		elif o in ('-b', '--bandwidth'):
+			bandwidth = float(a) * 1024
+		elif o in ('-e', '--error-rate'):
+			errorRate = float(a)
+		elif o in ('-s', '--exe-size'):
+			exeSize = int(a) * 1024
+		elif o in ('-a', '--assets'):
+			nAssets = int(a)
+		elif o in ('-w', '--windows'):
+			windows = [int(w) for w in a.split(',')]
+		elif o in ('-n', '--repeat'):
+			repeat = int(a)
+
+	top = tempfile.mkdtemp(prefix = 'bada-bench-')
+	cwd = os.getcwd()
+	try:
+		makeApp(top, exeSize, nAssets, 32 * 1024)
+		nbytes = appSize(top)
+		os.chdir(top)
+		broker.STATE_DIR = os.path.join(top, 'state')
+		print 'app: %d bytes, link: %.1f ms latency, %.0f kB/s, %.1f%% write errors' % (
+			nbytes, latency * 1000, bandwidth / 1024, errorRate * 100)
+		stats = Stats()
+		for window in windows:
+			emu = emulator.Emulator(latency, bandwidth, errorRate)
+			emu.start()
+			try:
+				t = run(stats, top, emu, window, repeat)
+			finally:
+				emu.stop()
+			print 'window %3d: upload %.3f s, %.3f MB/s' % (window, t, nbytes / t / 1e6)
+		stats.report()
+	finally:
+		os.chdir(cwd)
+		shutil.rmtree(top)
+
+if __name__ == "__main__":
+	main()
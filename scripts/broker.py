@@ -23,10 +23,29 @@ import re
 import getopt
 import os
 import sys
+import json
+import time
+import threading
+import Queue
+import collections
+import glob
+import select
+import errno
+import socket
+import bisect
+import copy
+import tempfile
+import marshal
+
+import catalog
 
 class TimeoutError(Exception):
-	def __init__(self):
-		pass
+	def __init__(self, msg = None):
+		self.msg = msg
+
+class ConnectionLostError(Exception):
+	def __init__(self, msg = None):
+		self.msg = msg
 
 class InvalidResponseError(Exception):
 	def __init__(self, res):
@@ -51,187 +70,809 @@ def readStringz(strg, start = 0):
 	zpos = strg.index('\0', start)
 	return strg[start:zpos]
 
+class FrameDecoder:
+	"""Incremental decoder for the byte stream received from the phone.
+	Feed it with whatever has been read from the port, and it will split
+	the data into \\x7f-framed responses, ESC debug blocks and AT lines,
+	appending them to the channel buffers passed to the constructor.
+	Incomplete data is kept until the next call to feed()."""
+
+	_textFrame = re.compile("\x04([0-9]{5})\|(-?[0-9]+:-?[0-9]+:-?[0-9]+)\|([A-Z]+):(-?[0-9]+)> (.*)")
+	_ackFrame = re.compile("\x04\[[0-9]+:[0-9]+\]")
+
+	def __init__(self, bufs):
+		self._bufs = bufs
+		# chunks of an incomplete message, kept unjoined until it can be
+		# completed, so that small reads do not copy the same bytes again
+		self._pending = []
+		self._npending = 0
+		# the incomplete message cannot be completed until there are
+		# at least _need bytes pending and _wait has been received
+		self._need = 0
+		self._wait = None
+		# offset in pending data from which to continue looking
+		# for the end of an incomplete debug block or AT line
+		self._scan = 0
+		self.nbytes = 0
+		self.nmessages = 0
+
+	def feed(self, data):
+		"""Decode data, appending complete messages to the channel buffers.
+		Raises InvalidResponseError when a \\x7f frame is not terminated
+		properly. The bad frame is dropped, so decoding may be continued."""
+		self.nbytes += len(data)
+		if self._pending:
+			self._pending.append(data)
+			self._npending += len(data)
+			if self._npending < self._need or (self._wait and not self._wait in data):
+				return
+			data = ''.join(self._pending)
+		pos = 0
+		end = len(data)
+		scan = self._scan
+		need = 0
+		wait = None
+		bufs = self._bufs
+		try:
+			while pos < end:
+				c = data[pos]
+				if c == '\x7f':
+					if end - pos < 3:
+						need = 3
+						break
+					rlen = struct.unpack_from('<H', data, pos + 1)[0]
+					fend = pos + 3 + rlen + 2
+					if fend > end:
+						need = fend - pos
+						break
+					r = data[pos + 3:fend]
+					pos = fend
+					if r[-1] != '\x7e':
+						raise InvalidResponseError(r)
+					self.nmessages += 1
+					self._frame(r[:-1])
+				elif c == '\x1b':
+					e = data.find(')\x1b\x03', max(pos, scan))
+					if e < 0:
+						scan = max(pos, end - 2)
+						wait = '\x03'
+						break
+					if data.startswith('\x1b\x02[', pos):
+						self.nmessages += 1
+						bufs['debug'].append(data[pos + 3:e])
+					pos = e + 3
+				else:
+					e = data.find('\n', max(pos, scan))
+					if e < 0:
+						scan = end
+						wait = '\n'
+						break
+					self.nmessages += 1
+					bufs['AT+'].append(data[pos:e + 1].strip())
+					pos = e + 1
+				scan = 0
+		finally:
+			if pos < end:
+				self._pending = [data[pos:] if pos else data]
+				self._npending = end - pos
+			else:
+				self._pending = []
+				self._npending = 0
+			self._need = need
+			self._wait = wait
+			self._scan = scan - pos if scan > pos else 0
+
+	def _frame(self, r):
+		bufs = self._bufs
+		if r[:1] == '\x04':
+			mo = self._textFrame.match(r)
+			if mo and mo.group(3) in bufs:
+				bufs[mo.group(3)].append((
+					int(mo.group(1)),
+					mo.group(2),
+					mo.group(3),
+					int(mo.group(4)),
+					mo.group(5)))
+				return
+			if self._ackFrame.match(r):
+				# ignore
+				return
+		bufs['raw'].append(r)
+
+class FrameWriter:
+	"""Builds the frames sent to the phone ('\\x7f', payload length and
+	command packed as '<HB', payload, '\\x7e') in place in a single buffer
+	allocated once, and passes them to write as memoryviews, so that sending
+	does not copy the payload or allocate anything of its size.
+	Fill payload and call send, or use sendPayload for short payloads.
+	AT commands, which are not framed, are sent from the same buffer."""
+
+	HEADER_SIZE = 4
+
+	def __init__(self, write, capacity = 0xffff):
+		self._write = write
+		self._buf = bytearray(self.HEADER_SIZE + capacity + 1)
+		self._view = memoryview(self._buf)
+		self.payload = self._view[self.HEADER_SIZE:self.HEADER_SIZE + capacity]
+
+	def send(self, cmd, n):
+		"""Send the first n bytes of payload framed as command cmd."""
+		struct.pack_into('<BHB', self._buf, 0, 0x7f, n, cmd)
+		self._buf[self.HEADER_SIZE + n] = 0x7e
+		self._write(self._view[:self.HEADER_SIZE + n + 1])
+
+	def sendPayload(self, cmd, *parts):
+		"""Send the concatenated parts framed as command cmd."""
+		n = 0
+		for part in parts:
+			self.payload[n:n + len(part)] = part
+			n += len(part)
+		self.send(cmd, n)
+
+	def sendRaw(self, data):
+		"""Send data as it is."""
+		self._buf[:len(data)] = data
+		self._write(self._view[:len(data)])
+
+def writeAll(fd, data):
+	"""Write all of data, a string or a buffer, to the file descriptor fd,
+	which may be non-blocking, without copying it."""
+	view = memoryview(data)
+	while len(view):
+		try:
+			n = os.write(fd, view)
+		except OSError, err:
+			if err.errno != errno.EAGAIN:
+				raise
+			select.select([], [fd], [])
+			continue
+		view = view[n:]
+
+class ChannelBuffer:
+	"""Bounded queue of the messages received on one channel. When it is
+	full, either the oldest message is discarded to make room for the new
+	one (DROP_OLDEST), or the new one is (DROP_NEWEST). Either way,
+	the number of discarded messages is counted in dropped."""
+	DROP_OLDEST = 0
+	DROP_NEWEST = 1
+	POLICIES = { 'drop-oldest': DROP_OLDEST, 'drop-newest': DROP_NEWEST }
+
+	def __init__(self, capacity = 4096, overflow = DROP_OLDEST):
+		self.capacity = capacity
+		self.overflow = overflow
+		self.dropped = 0
+		self._queue = collections.deque(maxlen = capacity)
+
+	def __len__(self):
+		return len(self._queue)
+
+	def append(self, msg):
+		if len(self._queue) == self.capacity:
+			self.dropped += 1
+			if self.overflow == self.DROP_NEWEST:
+				return
+		self._queue.append(msg)
+
+	def popleft(self):
+		return self._queue.popleft()
+
+	def popAll(self):
+		"""Remove all messages from the buffer and return them in a list."""
+		msgs = list(self._queue)
+		self._queue.clear()
+		return msgs
+
+STATE_DIR = os.path.expanduser('~/.bada-broker')
+
+class SyncState:
+	"""Remembers which directories and files (with their sizes and hashes)
+	were last uploaded for the given application to the given device,
+	so that the next install can skip what has not changed."""
+	def __init__(self, device, appId):
+		self._fileName = os.path.join(STATE_DIR, 'sync',
+			re.sub('[^A-Za-z0-9._-]', '_', '%s-%s' % (device, appId)) + '.json')
+		try:
+			d = json.load(open(self._fileName))
+		except (IOError, ValueError):
+			d = {}
+		self.dirs = set(d.get('dirs', []))
+		self.files = dict((k, tuple(v)) for k, v in d.get('files', {}).items())
+		# (name, (size, hash), offset) of the file whose upload was interrupted
+		# after the device had acknowledged offset bytes of it
+		self.partial = d.get('partial')
+		if self.partial:
+			self.partial = (self.partial[0], tuple(self.partial[1]), self.partial[2])
+
+	def forget(self):
+		self.dirs = set()
+		self.files = {}
+		self.partial = None
+
+	def resumeOffset(self, name, info):
+		"""Return the number of bytes of file name, with the given size
+		and hash, known to be on the device already."""
+		if self.partial and self.partial[0] == name and self.partial[1] == info:
+			return self.partial[2]
+		return 0
+
+	def save(self):
+		dirname = os.path.dirname(self._fileName)
+		if not os.path.isdir(dirname):
+			os.makedirs(dirname)
+		tmpName = self._fileName + '.tmp'
+		json.dump({ 'dirs': sorted(self.dirs), 'files': self.files, 'partial': self.partial },
+			open(tmpName, 'w'), indent = 1)
+		os.rename(tmpName, self._fileName)
+
+class Trace:
+	"""Records the data exchanged with the phone. At the SUMMARY level,
+	only the number of reads/writes and bytes per port is counted. At the
+	FULL level, everything is also captured to a binary file by a background
+	thread, together with the messages decoded from the data read. The
+	capture is a magic string followed by records consisting of a header
+	(time, port, direction, length) and the data, which for the decoded
+	messages is the channel and the message, marshalled."""
+
+	OFF = 0
+	SUMMARY = 1
+	FULL = 2
+	LEVELS = { 'off': OFF, 'summary': SUMMARY, 'full': FULL }
+
+	PORTS = ['cmd', 'debug']
+	DIRECTIONS = ['read', 'write']
+	# the direction of the records of decoded messages
+	MESSAGE = 2
+
+	_MAGIC = 'BADATRC\x01'
+	_HEADER = struct.Struct('<dBBI')
+
+	def __init__(self, level, fileName = 'broker.trace'):
+		self.level = level
+		self.counts = dict(((p, d), [0, 0]) for p in range(len(self.PORTS)) for d in range(len(self.DIRECTIONS)))
+		self._queue = None
+		if level >= self.FULL:
+			self._file = open(fileName, 'wb', 1 << 16)
+			self._file.write(self._MAGIC)
+			self._queue = Queue.Queue()
+			self._thread = threading.Thread(target = self._writer)
+			self._thread.daemon = True
+			self._thread.start()
+
+	def record(self, port, direction, data):
+		c = self.counts[(port, direction)]
+		c[0] += 1
+		c[1] += len(data)
+		if self._queue:
+			self._queue.put((time.time(), port, direction, data))
+
+	def message(self, port, channel, msg):
+		"""Record msg decoded from the data read from port and passed
+		to channel. Only the FULL level captures decoded messages."""
+		if self._queue:
+			self._queue.put((time.time(), port, self.MESSAGE, marshal.dumps((channel, msg))))
+
+	def _writer(self):
+		pack = self._HEADER.pack
+		while True:
+			recs = [self._queue.get()]
+			try:
+				while True:
+					recs.append(self._queue.get_nowait())
+			except Queue.Empty:
+				pass
+			out = []
+			for rec in recs:
+				if rec is None:
+					self._file.write(''.join(out))
+					return
+				t, port, direction, data = rec
+				out.append(pack(t, port, direction, len(data)))
+				out.append(data)
+			self._file.write(''.join(out))
+
+	def close(self):
+		if self._queue:
+			self._queue.put(None)
+			self._thread.join()
+			self._file.close()
+			self._queue = None
+
+	def summary(self):
+		return ''.join('%-5s %-5s %8d calls %10d bytes\n' % (
+			self.PORTS[p], self.DIRECTIONS[d], c[0], c[1]) for (p, d), c in sorted(self.counts.items()))
+
+	@classmethod
+	def load(cls, fileName):
+		"""Read a capture file and yield tuples (time, port, direction, data).
+		For decoded messages, direction is 'message' and data is
+		a tuple (channel, message)."""
+		f = open(fileName, 'rb')
+		if f.read(len(cls._MAGIC)) != cls._MAGIC:
+			raise ValueError, '%s is not a broker trace' % fileName
+		while True:
+			hdr = f.read(cls._HEADER.size)
+			if len(hdr) < cls._HEADER.size:
+				return
+			t, port, direction, n = cls._HEADER.unpack(hdr)
+			if direction == cls.MESSAGE:
+				yield t, cls.PORTS[port], 'message', marshal.loads(f.read(n))
+			else:
+				yield t, cls.PORTS[port], cls.DIRECTIONS[direction], f.read(n)
+
+def dumpTrace(fileName):
+	"""Print the contents of a capture file in a human-readable form."""
+	start = None
+	for t, port, direction, data in Trace.load(fileName):
+		if start is None:
+			start = t
+		if direction == 'message':
+			print '%12.6f %-5s %-5s %s %r' % (t - start, port, 'msg', data[0], data[1])
+			continue
+		print '%12.6f %-5s %-5s %5d' % (t - start, port, direction, len(data))
+		for i in xrange(0, len(data), 16):
+			line = data[i:i + 16]
+			print '    %04x  %-48s %s' % (i, toHex(line),
+				''.join(c if ' ' <= c <= '~' else '.' for c in line))
+
+class TracedChannel:
+	"""Stands in for a channel buffer passed to FrameDecoder, recording
+	the messages appended to it in a Trace before passing them on."""
+	def __init__(self, buf, trace, port, channel):
+		self._buf = buf
+		self._trace = trace
+		self._port = port
+		self._channel = channel
+
+	def append(self, msg):
+		self._trace.message(self._port, self._channel, msg)
+		self._buf.append(msg)
+
+class Stats:
+	"""Numbers describing how the broker talks to the phone: round trip
+	times of each kind of command, counters of bytes and messages sent
+	and received, retries and timeouts, and throughput of each file
+	uploaded or downloaded.
+	One object may be shared by many threads and SamsungWave objects."""
+	# upper bounds of the round trip time histogram buckets in ms,
+	# the last bucket counts everything slower
+	BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000]
+	FORMATS = ['summary', 'json']
+
+	def __init__(self):
+		self._lock = threading.Lock()
+		self.latency = {}
+		self.counters = {}
+		self.files = []
+
+	def time(self, name, seconds):
+		"""Add the round trip time of a command to its histogram."""
+		ms = seconds * 1000
+		with self._lock:
+			h = self.latency.get(name)
+			if h is None:
+				h = self.latency[name] = { 'count': 0, 'total': 0.0, 'min': ms, 'max': ms,
+					'buckets': [0] * (len(self.BUCKETS) + 1) }
+			h['count'] += 1
+			h['total'] += ms
+			h['min'] = min(h['min'], ms)
+			h['max'] = max(h['max'], ms)
+			h['buckets'][bisect.bisect_left(self.BUCKETS, ms)] += 1
+
+	def count(self, name, n = 1):
+		with self._lock:
+			self.counters[name] = self.counters.get(name, 0) + n
+
+	def file(self, name, nbytes, seconds, ok, direction = 'upload'):
+		with self._lock:
+			self.files.append({ 'name': name, 'bytes': nbytes, 'seconds': seconds, 'ok': ok,
+				'direction': direction })
+
+	def merge(self, other):
+		"""Add the numbers collected by other to this object."""
+		d = other.toDict()
+		with self._lock:
+			for name, h in d['latency'].items():
+				mine = self.latency.get(name)
+				if mine is None:
+					self.latency[name] = h
+					continue
+				mine['count'] += h['count']
+				mine['total'] += h['total']
+				mine['min'] = min(mine['min'], h['min'])
+				mine['max'] = max(mine['max'], h['max'])
+				mine['buckets'] = [a + b for a, b in zip(mine['buckets'], h['buckets'])]
+			for name, n in d['counters'].items():
+				self.counters[name] = self.counters.get(name, 0) + n
+			self.files.extend(d['files'])
+
+	def toDict(self):
+		"""Return the numbers in a form which can be dumped as JSON."""
+		with self._lock:
+			return copy.deepcopy({ 'buckets': self.BUCKETS, 'latency': self.latency,
+				'counters': self.counters, 'files': self.files })
+
+	@classmethod
+	def fromDict(cls, d):
+		stats = cls()
+		stats.latency = d['latency']
+		stats.counters = d['counters']
+		stats.files = d['files']
+		return stats
+
+	def _percentile(self, h, p):
+		n = 0
+		for bound, count in zip(self.BUCKETS, h['buckets']):
+			n += count
+			if n >= h['count'] * p:
+				return str(bound)
+		return '>%d' % self.BUCKETS[-1]
+
+	def summary(self):
+		with self._lock:
+			lines = ['%-24s %7s %9s %9s %9s %9s %9s' % (
+				'round trip', 'count', 'mean ms', 'min ms', 'max ms', 'p50 ms<=', 'p95 ms<=')]
+			for name in sorted(self.latency):
+				h = self.latency[name]
+				lines.append('%-24s %7d %9.1f %9.1f %9.1f %9s %9s' % (name, h['count'],
+					h['total'] / h['count'], h['min'], h['max'],
+					self._percentile(h, 0.5), self._percentile(h, 0.95)))
+			for name in sorted(self.counters):
+				lines.append('%-32s %12d' % (name, self.counters[name]))
+			for f in self.files:
+				lines.append('%s %s: %d bytes in %.2f s, %.1f kB/s%s' % (f.get('direction', 'upload'),
+					f['name'], f['bytes'], f['seconds'],
+					f['bytes'] / max(f['seconds'], 1e-6) / 1024, '' if f['ok'] else ', failed'))
+		return '\n'.join(lines) + '\n'
+
+def writeStats(stats, format, fileName = None):
+	"""Write the numbers collected in stats as a summary or as JSON
+	to the given file, or to stderr."""
+	out = open(fileName, 'w') if fileName else sys.stderr
+	try:
+		if format == 'json':
+			json.dump(stats.toDict(), out, indent = 1, sort_keys = True)
+			out.write('\n')
+		else:
+			out.write(stats.summary())
+	finally:
+		if fileName:
+			out.close()
+
 class SamsungWave:
 	"""A class to talk to your phone"""
-	def __init__(self, port = '/dev/ttyACM0'):
-		"""Yes, this is the constructor. It opens the port, which by default
-		is /dev/ttyACM0, as the device appears on my computer under this name."""
+	def __init__(self, port = '/dev/ttyACM0', debugPort = '/dev/ttyACM1', trace = None,
+			capacity = 4096, overflow = ChannelBuffer.DROP_OLDEST, stats = None, openPort = serial.Serial):
+		"""Yes, this is the constructor. It opens the ports, which by default
+		are /dev/ttyACM0 and /dev/ttyACM1, as the device appears on my computer
+		under these names. If trace is given, everything read from
+		and written to the ports is recorded in it. If stats is given, it
+		collects the round trip times and other numbers, see Stats.
+		Up to capacity messages
+		are kept for each channel until they are received, see ChannelBuffer.
+		The responses to the commands sent by the broker are always kept,
+		so the channels of the command port can hold at least
+		_RESPONSE_CAPACITY messages, which must be more than the window.
+		The ports are opened by openPort, called like serial.Serial,
+		which it may be replaced with, e.g. to replay a capture."""
 		# dsrdtr is ignored on Linux, but here it is included to remind you that the
 		# original broker enables it
-		self._ser = serial.Serial(port, 115200, timeout = 1, dsrdtr = 1, rtscts = 1)
+		self._ser = openPort(port, 115200, timeout = 1, dsrdtr = 1, rtscts = 1)
 		self._ser.flushInput()
 		self._ser.flushOutput()
-		self._recbufs = { 'AT+': [], 'raw': [], 'PHONESTATUS': [], 'PROCESSMGR': [], 'debug': [] }
-		self._recbufsx = { 'AT+': [], 'raw': [], 'PHONESTATUS': [], 'PROCESSMGR': [], 'debug': [] }
-		self._logf = file('broker.log', 'w')
-		self._serx = serial.Serial('/dev/ttyACM1', 115200, timeout = 1, dsrdtr = 1, rtscts = 1)
-		self._serx.write('AT+WINCOMM\r')
+		self._recbufs = dict((c, ChannelBuffer(max(capacity, self._RESPONSE_CAPACITY), overflow))
+			for c in self._CHANNELS)
+		self._recbufsx = dict((c, ChannelBuffer(capacity, overflow)) for c in self._CHANNELS)
+		decoderBufs = [self._recbufs, self._recbufsx]
+		if trace and trace.level >= Trace.FULL:
+			decoderBufs = [dict((c, TracedChannel(buf, trace, port, c)) for c, buf in bufs.items())
+				for port, bufs in enumerate(decoderBufs)]
+		self._decoder = FrameDecoder(decoderBufs[0])
+		self._decoderx = FrameDecoder(decoderBufs[1])
+		self._frames = FrameWriter(lambda b: self._swrite(self._ser, b))
+		# the number of frames sent on the command port, each of which
+		# is answered by the phone, see InstallPlan
+		self.framesSent = 0
+		self.window = self._WINDOW
+		# None for _CHUNK_SIZE, unless install finds a size tuned for the model
+		self.chunkSize = None
+		self._trace = trace
+		self.stats = stats
+		# directory listings, see readDirectory
+		self._dirCache = {}
+		self._cacheEpoch = 0
+		self._serx = openPort(debugPort, 115200, timeout = 1, dsrdtr = 1, rtscts = 1)
+		self._swrite(self._serx, 'AT+WINCOMM\r')
 		self._serx.flushInput()
 		self._serx.flushOutput()
+		# Both ports are drained continuously by reader threads, which decode
+		# the data into the channel buffers and wake up anyone waiting in _receive.
+		self._running = True
+		self._readerError = None
+		self._cond = { 'cmd': threading.Condition(), 'debug': threading.Condition() }
+		self._readers = [
+			threading.Thread(target = self._reader, args = ('cmd', self._ser, self._decoder)),
+			threading.Thread(target = self._reader, args = ('debug', self._serx, self._decoderx)) ]
+		for t in self._readers:
+			t.daemon = True
+			t.start()
+
+	_CHANNELS = ['AT+', 'raw', 'PHONESTATUS', 'PROCESSMGR', 'debug']
+	_RESPONSE_CAPACITY = 256
+
+	# how often the reader threads wake up to check if close() has been called
+	_POLL_INTERVAL = 0.05
 
 	def _sread(self, port, b = 1):
 		a = port.read(b)
-		n = -1
-		if not a is None:
-			n = len(a)
-		self._logf.write('read:  %5d %5d %s\n' % (b, n, repr(a)))
-		return a
-
-	def _sreadline(self, port):
-		a = port.readline()
-		n = -1
-		if not a is None:
-			n = len(a)
-		self._logf.write('readl:       %5d %s\n' % (len(a), repr(a)))
+		if self._trace:
+			self._trace.record(0 if port is self._ser else 1, 0, a)
+		if self.stats and a:
+			self.stats.count('bytes received (%s)' % ('cmd' if port is self._ser else 'debug'), len(a))
 		return a
 
 	def _swrite(self, port, b):
-		a = port.write(b)
-		self._logf.write('write: %5d       %s\n' % (len(b), repr(b)))
-		return a
+		"""Write b, a string or a memoryview, to the port. On POSIX, it goes
+		straight to the port's file descriptor, which takes any buffer,
+		while pyserial would turn it into a string first."""
+		try:
+			fd = getattr(port, 'fd', None)
+			if fd is not None:
+				writeAll(fd, b)
+			else:
+				port.write(b.tobytes() if isinstance(b, memoryview) else b)
+		except (serial.SerialException, EnvironmentError), err:
+			raise ConnectionLostError(str(err))
+		if self._trace:
+			self._trace.record(0 if port is self._ser else 1, 1, b.tobytes() if isinstance(b, memoryview) else b)
+		if self.stats:
+			self.stats.count('bytes sent (%s)' % ('cmd' if port is self._ser else 'debug'), len(b))
+		return len(b)
+
+	def _count(self, name, n = 1):
+		if self.stats:
+			self.stats.count(name, n)
+
+	def _time(self, name, start):
+		"""Record the round trip time of a command sent at start."""
+		if self.stats:
+			self.stats.time(name, time.time() - start)
+
+	def close(self):
+		self._running = False
+		for t in self._readers:
+			t.join()
+		self._ser.close()
+		self._serx.close()
+
+	def _reader(self, port, ser, dec):
+		cond = self._cond[port]
+		ser.timeout = self._POLL_INTERVAL
+		while self._running:
+			try:
+				# block for the first byte, then take everything that is already there
+				s = self._sread(ser, max(1, ser.inWaiting()))
+			except (serial.SerialException, EnvironmentError), err:
+				with cond:
+					self._readerError = err
+					cond.notify_all()
+				return
+			with cond:
+				if s:
+					n = dec.nmessages
+					while True:
+						try:
+							dec.feed(s)
+							break
+						except InvalidResponseError, err:
+							self._count('invalid frames')
+							sys.stderr.write('Warning: invalid frame: %s\n' % repr(err.msg))
+							# decode what came after the bad frame, which
+							# would otherwise wait for more data to arrive
+							s = ''
+					self._count('messages received (%s)' % port, dec.nmessages - n)
+				cond.notify_all()
 
 	def _receive(self, port, channel, timeout = 1):
-		ser = self._ser if port == 'cmd' else self._serx
+		"""Wait up to timeout seconds for a message on the given channel
+		of the given port ('cmd' or 'debug'), and return it. Return None
+		if nothing arrives in time. Raise ConnectionLostError if the ports
+		cannot be read anymore."""
 		buf = self._recbufs if port == 'cmd' else self._recbufsx
 		if not channel in buf:
 			return None
-		ser.timeout = timeout
-		while not len(buf[channel]):
-			s = self._sread(ser, 1)
-			if not s:
-				return None
-			if s == '\x7f':
-				rd = self._sread(ser, 2)
-				rlen = struct.unpack("<H", rd)
-				r = self._sread(ser, rlen[0] + 2)
-				if r[-1] != '\x7e':
-					raise InvalidResponseError(r)
-				mo = re.match("\x04([0-9]{5})\|(-?[0-9]+:-?[0-9]+:-?[0-9]+)\|([A-Z]+):(-?[0-9]+)> (.*)", r[0:-1])
-				if mo and mo.group(3) in buf:
-					buf[mo.group(3)].append((
-						int(mo.group(1)),
-						mo.group(2),
-						mo.group(3),
-						int(mo.group(4)),
-						mo.group(5)))
-				else:
-					mo = re.match("\x04\[[0-9]+:[0-9]+\]", r)
-					if mo:
-						# ignore
-						pass
-					else:
-						buf['raw'].append(r[0:-1])
-			elif s == '\x1b':
-				# TODO: rewrite in a safer way
-				r = s + self._sread(ser, 1)
-				while r:
-					mo = re.match('\x1b\x02\[(.*?)\)\x1b\x03', r, re.DOTALL)
-					if mo:
-						buf['debug'].append(mo.group(1))
-						r = r[len(mo.group(0)):]
-					else:
-						r += self._sread(ser, 1)
-			else:
-				if s != '\n':
-					r = self._sreadline(ser)
-					if r is None:
-						raise InvalidResponseError(r)
-					s += r
-				buf['AT+'].append(string.strip(s))
-		return buf[channel].pop(0)
+		cond = self._cond['cmd' if port == 'cmd' else 'debug']
+		deadline = time.time() + timeout
+		with cond:
+			while not buf[channel]:
+				if self._readerError:
+					raise ConnectionLostError(str(self._readerError))
+				if time.time() >= deadline:
+					return None
+				cond.wait(deadline - time.time())
+			return buf[channel].popleft()
+
+	def _receiveAll(self, port, channel, timeout = 1):
+		"""Like _receive, but return the list of all messages waiting
+		on the channel, which is empty if nothing arrives in time."""
+		buf = self._recbufs if port == 'cmd' else self._recbufsx
+		if not channel in buf:
+			return []
+		cond = self._cond['cmd' if port == 'cmd' else 'debug']
+		deadline = time.time() + timeout
+		with cond:
+			while not buf[channel]:
+				if self._readerError:
+					raise ConnectionLostError(str(self._readerError))
+				if time.time() >= deadline:
+					return []
+				cond.wait(deadline - time.time())
+			return buf[channel].popAll()
+
+	def dropped(self):
+		"""Return a dictionary with the number of messages discarded
+		because nobody received them in time, by port and channel."""
+		res = {}
+		for port, bufs in (('cmd', self._recbufs), ('debug', self._recbufsx)):
+			for channel, buf in bufs.items():
+				with self._cond[port]:
+					if buf.dropped:
+						res[(port, channel)] = buf.dropped
+		return res
 
 	def _AT(self, command):
-		self._swrite(self._ser, command + "\r\n")
-		result = []
-		while True:
-			r = self._receive('cmd', 'AT+')
-			if r is None:
-				return None
-			if r and r != command:
-				result.append(r)
-			if r == "OK" or r == "ERROR":
-				return result
+		return self._ATpipeline([command])[0]
 
-	def getModel(self):
-		"""Query the device for model name. Return string containing
-		the received identifier or None, if no valid answer was received."""
-		ans = self._AT("AT+CGMM")
+	def _ATpipeline(self, commands):
+		"""Send the AT commands back to back, without waiting for the
+		answers in between, and return the list of the answers, which are
+		lists of lines ending with OK or ERROR, in the order of commands.
+		The commands which have not been answered in time get None.
+		The phone answers them one by one, so each is timed from the end
+		of the answer to the one before, and only the first from sending."""
+		start = time.time()
+		self._frames.sendRaw(''.join(command + "\r\n" for command in commands))
+		answers = []
+		for command in commands:
+			result = []
+			while True:
+				r = self._receive('cmd', 'AT+')
+				if r is None:
+					self._count('timeouts')
+					return answers + [None] * (len(commands) - len(answers))
+				if r and not r in commands:
+					result.append(r)
+				if r == "OK" or r == "ERROR":
+					self._time(command, start)
+					start = time.time()
+					answers.append(result)
+					break
+		return answers
+
+	def _singleLine(self, ans):
 		if ans != None and len(ans) == 2 and ans[1] == "OK":
 			return ans[0]
 		else:
 			return None
 
+	def _userMem(self, ans):
+		mo = re.search("^\+USERMEM:([0-9]+)k$", self._singleLine(ans) or '')
+		if not mo:
+			return None
+		return int(mo.group(1)) * 1024
+
+	def _lcdInfo(self, ans):
+		if ans != None and ans[:1] == ['ERROR']:
+			ans = self._AT('AT+LCDINFO:MAIN')
+		if ans != None and ans[-1:] == ['OK']:
+			for line in ans:
+				mo = re.search('^\+LCDINFO: ([0-9]+), ([0-9]+)$', line)
+				if mo:
+					return (int(mo.group(1)), int(mo.group(2)))
+		return None
+
+	def getModel(self):
+		"""Query the device for model name. Return string containing
+		the received identifier or None, if no valid answer was received."""
+		return self._singleLine(self._AT("AT+CGMM"))
+
+	def getSerialNumber(self):
+		"""Query the device for its serial number (IMEI). Return string
+		containing the received number or None, if no valid answer was received."""
+		return self._singleLine(self._AT("AT+CGSN"))
+
 	def getUserMem(self):
 		"""Query the device for user memory size. Return memory size
 		in bytes or None, if no valid answer was received."""
-		ans = self._AT("AT+USERMEM")
-		if ans != None and len(ans) == 2 and ans[1] == "OK":
-			mo = re.search("^\+USERMEM:([0-9]+)k$", ans[0])
-			if not mo:
-				return None
-			return int(mo.group(1)) * 1024
-		else:
-			return None
+		return self._userMem(self._AT("AT+USERMEM"))
 
 	def getLcdInfo(self):
 		"""Query the device for the LCD dimensions. Return tuple
 		(width, height) or None, if no valid answer was received."""
-		ans = self._AT('AT+LCDINFO')
-		if ans != None:
-			if len(ans) == 2 and ans[1] == 'OK':
-				mo = re.search('^\+LCDINFO: ([0-9]+), ([0-9]+)$', ans[0])
-				if mo:
-					return (int(mo.group(1)), int(mo.group(2)))
-			elif ans[0] == 'ERROR':
-				ans = self._AT('AT+LCDINFO:MAIN')
-				if ans != None and len(ans) > 2 and ans[1] == 'OK':
-					mo = re.search('^\+LCDINFO: ([0-9]+), ([0-9]+)$', ans[0])
-					if mo:
-						return (mo.group[1], mo.group[2])
-		return None
+		return self._lcdInfo(self._AT('AT+LCDINFO'))
 
-	def _send(self, cmd, payload):
-		"""
-		"""
-		frame = '\x7f' + struct.pack('<HB', len(payload), cmd) + payload + '\x7e'
-		self._swrite(self._ser, frame)
+	def _send(self, cmd, *payload):
+		"""Send a frame with command cmd and the concatenated payload parts."""
+		self._frames.sendPayload(cmd, *payload)
+		self.framesSent += 1
+		self._count('frames sent')
 
 	def isInstallationPossible(self, appId, nbytes):
 		"""
 		"""
+		start = time.time()
 		self._send(4, "[1600:1601]GetAppInstallCondition %s %d" % ( appId, nbytes ))
+		return self._installCondition(start) is True
+
+	def _installCondition(self, start):
+		"""Return True if the device has answered GetAppInstallCondition
+		sent at start with no error, False if with an error, and None
+		if it has not answered in time."""
 		while True:
 			r = self._receive('cmd', 'PHONESTATUS', 3)
 			if r is None:
-				return False
+				self._count('timeouts')
+				return None
 			mo = re.search('errType=([0-9]+)', r[4])
 			if mo:
+				self._time('GetAppInstallCondition', start)
 				return mo.group(1) == '0'
 
+	def preflight(self, appId, nbytes):
+		"""Ask the device what install needs to know before uploading
+		the application appId taking nbytes: the model name, serial number,
+		LCD dimensions, user memory size, and if it agrees to install it.
+		All the queries are sent back to back, so it takes about as long
+		as one of them. Return a dictionary with keys 'model', 'serial',
+		'lcd', 'userMem' and 'possible', which are None if not answered,
+		like the get* methods and _installCondition return."""
+		start = time.time()
+		self._send(4, "[1600:1601]GetAppInstallCondition %s %d" % ( appId, nbytes ))
+		model, serial, lcd, userMem = self._ATpipeline(['AT+CGMM', 'AT+CGSN', 'AT+LCDINFO', 'AT+USERMEM'])
+		res = {
+			'model': self._singleLine(model),
+			'serial': self._singleLine(serial),
+			'lcd': self._lcdInfo(lcd),
+			'userMem': self._userMem(userMem),
+			'possible': self._installCondition(start) }
+		self._time('preflight', start)
+		return res
+
 	def appTerminate(self, appId):
 		"""
 		"""
+		start = time.time()
 		self._send(4, "[1600:1601]TerminateProcessEx %s 0" % appId)
+		# whatever the app has been doing, it might have left some files
+		self._invalidateApp(appId)
 		ans = []
 		while True:
 			r = self._receive('cmd', 'PROCESSMGR')
 			if not r:
+				# includes the second of silence which ends the answer
+				self._time('TerminateProcessEx', start)
 				return ans
 			ans.append(r)
 
 	def appInstall(self, appId):
+		start = time.time()
 		self._send(4, '[1600:1601]EnableDiagWrite')
 		self._send(4, '[1600:1601]AppPkgInstall /Osp/Applications/' + appId)
+		self._invalidateApp(appId)
 		self._send(4, '[0:2]MID_PROCESSMGR,0xFF')
 		self._send(4, '[0:2]MID_DIAGMGR,0xFF')
 		self._send(4, '[0:2]MID_DIAGMGR,0xFF')
 		r = self._receive('cmd', 'PHONESTATUS', 10)
+		if r is None:
+			self._count('timeouts')
+			raise TimeoutError('No response to AppPkgInstall')
 		mo = re.search('errType=([0-9]+)', r[4])
 		if not mo:
 			raise InvalidResponseError(r)
+		self._time('AppPkgInstall', start)
 		return mo.group(1) == '0'
 
 	def appRun(self, appId, exeFileName):
+		self._invalidateApp(appId)
 		self._send(4, '[1400:1400]/Osp/Applications/' + appId + '/Bin/' + exeFileName + ',/Osp/Applications/' + appId + '/Bin')
 
 	_FILE_OPEN = 0x00
@@ -245,14 +886,38 @@ class SamsungWave:
 	_DIR_READ = 0x08
 	_DIR_CLOSE = 0x09
 
+	_OPCODES = { _FILE_OPEN: 'FILE_OPEN', _FILE_CLOSE: 'FILE_CLOSE', _FILE_WRITE: 'FILE_WRITE',
+		_FILE_READ: 'FILE_READ', _FILE_DELETE: 'FILE_DELETE', _DIR_CREATE: 'DIR_CREATE',
+		_DIR_DELETE: 'DIR_DELETE', _DIR_OPEN: 'DIR_OPEN', _DIR_READ: 'DIR_READ', _DIR_CLOSE: 'DIR_CLOSE' }
+
+	# modes for _FILE_OPEN; 0x09 is what the original Broker.exe uses,
+	# the append mode is a guess, so the size of the file is checked
+	# before and after a transfer is resumed
+	_OPEN_WRITE = 0x09
+	_OPEN_APPEND = 0x0a
+
 	_CHUNK_SIZE = 0x5dc
+	_WINDOW = 8
+
+	# the largest payload of a write command fitting in a frame,
+	# and the sizes tried by tuneChunkSize
+	_MAX_CHUNK_SIZE = 0xffff - 2
+	_PROBE_SIZES = [_CHUNK_SIZE, 0x800, 0x1000, 0x2000, 0x4000, 0x8000, _MAX_CHUNK_SIZE]
 
 	def _fileCommand(self, cmd, payload = ''):
 		"""
 		"""
-		self._send(0x30, struct.pack("<BB", cmd, 0) + payload)
+		start = time.time()
+		self._send(0x30, chr(cmd) + '\x00', payload)
+		r = self._fileResponse(cmd)
+		self._time(self._OPCODES.get(cmd, 'FILE_%02x' % cmd), start)
+		return r
+
+	def _fileResponse(self, cmd):
+		"""Wait for the response to file command cmd and unpack it."""
 		r = self._receive('cmd', 'raw', 5)
 		if not r:
+			self._count('timeouts')
 			raise TimeoutError, 'No response on file command'
 		if ord(r[0]) != 0x30 or ord(r[1]) != (cmd | 0xe0):
 			print "Warning: Invalid response for file command %02x: %s" % (cmd, repr(r))
@@ -260,52 +925,267 @@ class SamsungWave:
 		r = struct.unpack("<iHH", r[2:10]) + (r[10:],)
 		return r
 
-	def sendFile(self, localFileName, remoteFileName):
-		"""
-		"""
-		f = open(localFileName)
-		ans = self._fileCommand(self._FILE_OPEN, "\x09\x00\x00\x00%s\x00" % remoteFileName)
+	def sendFile(self, localFileName, remoteFileName, window = None, offset = 0, progress = None):
+		"""Send a file to your phone. Up to window write commands are sent
+		ahead without waiting for their responses. If anything goes wrong
+		with a pipelined transfer, the file is sent again chunk by chunk.
+		If offset is given, the first offset bytes are assumed to be on the
+		phone already, and the rest is appended, if possible. progress is
+		called with the number of bytes acknowledged by the phone so far.
+		Return True if the whole file was acknowledged by the device."""
+		self._cacheEpoch += 1
+		start = time.time()
+		ok = self._upload(localFileName, remoteFileName, window, offset, progress)
+		if self.stats:
+			self.stats.file(remoteFileName, os.path.getsize(localFileName) - offset, time.time() - start, ok)
+		if ok:
+			self._cacheSet(remoteFileName, 1, os.path.getsize(localFileName))
+		else:
+			self.invalidateCache(remoteFileName.rsplit('/', 1)[0])
+		return ok
+
+	def _upload(self, localFileName, remoteFileName, window, offset, progress):
+		if window is None:
+			window = self.window
+		if offset:
+			offset = self._resumeOffset(remoteFileName, offset, os.path.getsize(localFileName))
+			if offset:
+				print 'resume %s at %d' % (remoteFileName, offset)
+				if self._sendFile(localFileName, remoteFileName, window, offset, progress):
+					if self._remoteSize(remoteFileName) == os.path.getsize(localFileName):
+						return True
+					print "Warning: sendFile: %s has not been appended to" % remoteFileName
+				else:
+					self._drain('cmd', 'raw')
+			self._count('upload retries')
+			print "Warning: sendFile: cannot resume %s, sending it again" % remoteFileName
+		if window > 1 or (self.chunkSize or self._CHUNK_SIZE) != self._CHUNK_SIZE:
+			if self._sendFile(localFileName, remoteFileName, window, 0, progress):
+				return True
+			self._count('upload retries')
+			print "Warning: sendFile: transfer failed, retrying chunk by chunk"
+			self._drain('cmd', 'raw')
+		return self._sendFile(localFileName, remoteFileName, 1, 0, progress, self._CHUNK_SIZE)
+
+	def _resumeOffset(self, remoteFileName, offset, size):
+		"""Check how much of the interrupted upload is there on the phone.
+		The phone may have written more than it had acknowledged before the
+		connection dropped. Return the offset to resume at or 0."""
+		rsize = self._remoteSize(remoteFileName)
+		if rsize is not None and offset <= rsize <= size:
+			return rsize
+		return 0
+
+	def _remoteSize(self, remoteFileName):
+		"""Return the size of the file on the phone, as listed now,
+		or None if it is not there."""
+		dirname, basename = remoteFileName.rsplit('/', 1)
+		self.invalidateCache(dirname)
+		for attr, size, name in list(self.readDirectory(dirname)):
+			if attr == 1 and name == basename:
+				return size
+		return None
+
+	def _sendFile(self, localFileName, remoteFileName, window, offset, progress, chunkSize = None):
+		mode = self._OPEN_APPEND if offset else self._OPEN_WRITE
+		ans = self._fileCommand(self._FILE_OPEN, struct.pack('<I', mode) + remoteFileName + '\x00')
 		if ans[0] < 0:
 			print "Error: sendFile:", ans
-			return
+			return False
 		if ans[1] != 3:
 			print "Warning: sendFile:", ans
-		for chunk in readByChunk(open(localFileName), self._CHUNK_SIZE):
-			ans = self._fileCommand(self._FILE_WRITE, chunk)
-			if ans[0] < 0:
-				print "Error: sendFile write:", ans
-				return
-			if ans[1] != 3:
-				print "Warning: sendFile write:", ans
-		ans = self._fileCommand(self._FILE_CLOSE)
-		if ans[0] < 0 or ans[1] != 3:
-			print "Warning: sendFile close:", ans
-	
-	def getFile(self, localFileName, remoteFileName):
-		"""
-		"""
-		f = open(localFileName, 'w')
+		if progress:
+			progress(offset)
+		# sizes and send times of the chunks awaiting acknowledgement
+		inflight = collections.deque()
+		def acknowledged():
+			size, start = inflight.popleft()
+			self._time('FILE_WRITE', start)
+			return size
+		acked = offset
+		ok = True
+		# the chunks are read straight into the frame, after the write command
+		frames = self._frames
+		header = chr(self._FILE_WRITE) + '\x00'
+		data = frames.payload[len(header):len(header) + (chunkSize or self.chunkSize or self._CHUNK_SIZE)]
+		f = None
+		try:
+			f = open(localFileName, 'rb')
+			f.seek(offset)
+			while True:
+				n = f.readinto(data)
+				if not n:
+					break
+				if len(inflight) == window:
+					if not self._writeAcknowledged():
+						inflight.popleft()
+						ok = False
+						break
+					acked += acknowledged()
+					if progress:
+						progress(acked)
+				inflight.append((n, time.time()))
+				frames.payload[:len(header)] = header
+				frames.send(0x30, len(header) + n)
+				self.framesSent += 1
+				self._count('frames sent')
+			while inflight:
+				if self._writeAcknowledged() and ok:
+					acked += acknowledged()
+					if progress:
+						progress(acked)
+				else:
+					inflight.popleft()
+					ok = False
+		except TimeoutError, err:
+			print "Error: sendFile write:", err.msg
+			# the late acknowledgements must not be taken for the answer to close
+			self._drain('cmd', 'raw')
+			ok = False
+		finally:
+			if f:
+				f.close()
+			# leave the file closed on the phone, or it cannot be opened again
+			# by the retry; the phone may be gone, though, if writing has failed
+			try:
+				ans = self._fileCommand(self._FILE_CLOSE)
+				if ans is None or ans[0] < 0 or ans[1] != 3:
+					print "Warning: sendFile close:", ans
+			except TimeoutError, err:
+				print "Warning: sendFile close:", err.msg
+				ok = False
+		return ok
+
+	def _writeAcknowledged(self):
+		ans = self._fileResponse(self._FILE_WRITE)
+		if ans is None or ans[0] < 0:
+			print "Error: sendFile write:", ans
+			return False
+		if ans[1] != 3:
+			print "Warning: sendFile write:", ans
+		return True
+
+	def _drain(self, port, channel, timeout = 0.5):
+		"""Discard anything received on channel until nothing more arrives."""
+		while not self._receive(port, channel, timeout) is None:
+			pass
+
+	def getFile(self, localFileName, remoteFileName, window = None, size = None):
+		"""Download a file from your phone to localFileName. Each chunk
+		is written to localFileName.part as soon as it arrives, and the
+		file is renamed when it is complete. Up to window read commands are
+		sent ahead without waiting for their responses. size is the size
+		of the remote file, which is listed again if not given, so that
+		no more reads are sent ahead than needed. The file may have grown
+		or shrunk since, so it is read until the phone returns a short
+		or empty chunk anyway. If anything goes wrong with a pipelined
+		transfer, the file is read again chunk by chunk. Return True
+		if the whole file has been received."""
+		if window is None:
+			window = self.window
+		if size is None:
+			# the files worth downloading are written by the application,
+			# which the cached listing knows nothing about
+			self.invalidateCache(remoteFileName.rsplit('/', 1)[0])
+			ent = self.stat(remoteFileName)
+			if not ent or ent[0] != 1:
+				print "Error: getFile: no such file:", remoteFileName
+				return False
+			size = ent[1]
+		start = time.time()
+		partName = localFileName + '.part'
+		received = self._getFile(partName, remoteFileName, window, size)
+		if received is None and window > 1:
+			self._count('download retries')
+			print "Warning: getFile: transfer failed, retrying chunk by chunk"
+			self._drain('cmd', 'raw')
+			received = self._getFile(partName, remoteFileName, 1, size)
+		if self.stats:
+			self.stats.file(remoteFileName, received or 0, time.time() - start, received is not None, 'download')
+		if received is None:
+			return False
+		os.rename(partName, localFileName)
+		return True
+
+	def _getFile(self, localFileName, remoteFileName, window, size):
+		"""Return the number of bytes received, or None if the transfer has failed."""
 		ans = self._fileCommand(self._FILE_OPEN, "%s\x00" % remoteFileName)
-		if ans[0] != 0:
+		if ans is None or ans[0] != 0:
 			print "Error: getFile:", ans
-			return
+			return None
 		if ans[1:3] != (3, 6):
 			print "Warning: getFile:", ans
-		ans = self._fileCommand(self._FILE_READ)
-		print ans
+		f = open(localFileName, 'wb')
+		# send times of the reads awaiting responses
+		inflight = collections.deque()
+		received = 0
+		# the phone decides how much it sends at once, so only one read
+		# is sent until the first chunk tells how many more are needed;
+		# past the expected size, one read at a time looks for the end
+		chunkSize = None
+		ok = True
+		try:
+			while True:
+				while not inflight or (chunkSize and len(inflight) < window and
+						received + len(inflight) * chunkSize < size):
+					inflight.append(time.time())
+					self._send(0x30, chr(self._FILE_READ) + '\x00')
+				ans = self._fileResponse(self._FILE_READ)
+				self._time('FILE_READ', inflight.popleft())
+				if ans is None or ans[0] < 0:
+					print "Error: getFile read:", ans
+					ok = False
+					break
+				data = ans[3]
+				f.write(data)
+				received += len(data)
+				if not data or (chunkSize and len(data) < chunkSize):
+					break
+				chunkSize = chunkSize or len(data)
+			# only if the file has shrunk, and then there is nothing more to read
+			while inflight:
+				inflight.popleft()
+				self._fileResponse(self._FILE_READ)
+			if ok and received != size:
+				print "Warning: getFile: %s has changed, %d bytes received, %d listed" % (
+					remoteFileName, received, size)
+		except TimeoutError, err:
+			print "Error: getFile read:", err.msg
+			self._drain('cmd', 'raw')
+			ok = False
+		finally:
+			f.close()
 		ans = self._fileCommand(self._FILE_CLOSE)
+		if ans is None or ans[0] < 0 or ans[1] != 3:
+			print "Warning: getFile close:", ans
+		return received if ok else None
 
-	def deleteFile(self, remoteFileName):
-		"""Deletes a file on your phone"""
+	def deleteFile(self, remoteFileName, missingOk = False):
+		"""Deletes a file on your phone. If missingOk is True, the file
+		may not be there, and the phone's complaint is not shown."""
+		if self._cached(remoteFileName) is False:
+			return
+		self._cacheEpoch += 1
 		ans = self._fileCommand(0x04, "%s\x00" % remoteFileName)
 		if ans[0:3] != (0, 3, 6):
-			print "Warning: deleteFile:", ans
+			if not missingOk:
+				print "Warning: deleteFile:", ans
+			self.invalidateCache(remoteFileName.rsplit('/', 1)[0])
+		else:
+			self._cacheRemove(remoteFileName)
 
 	def createDirectory(self, remoteDirName):
 		"""Supposedly, this should create a directory on your phone."""
+		ent = self._cached(remoteDirName)
+		if ent and ent[0] == 2:
+			return
+		self._cacheEpoch += 1
 		ans = self._fileCommand(0x05, "%s\x00" % remoteDirName)
 		if ans[0] < 0:
 			print "Error: create directory:", ans
+			self.invalidateCache(remoteDirName.rsplit('/', 1)[0])
+		else:
+			self._cacheSet(remoteDirName, 2, 0)
 		if ans[1] != 3:
 			print "Warning: create directory:", ans
 
@@ -313,23 +1193,36 @@ class SamsungWave:
 		"""Based on when and how it is used by the original Broker.exe,
 		I would guess this is a command to remove a directory."""
 		if recursive:
-			for ent in self.readDirectory(remoteDirName):
+			for ent in list(self.readDirectory(remoteDirName)):
 				if ent[0] == 2 and (not (ent[2] == '.' or ent[2] == '..')):
 						self.deleteDirectory(remoteDirName + '/' + ent[2], True)
 				elif ent[0] == 1:
 					self.deleteFile(remoteDirName + '/' + ent[2])
+		self._cacheEpoch += 1
 		ans = self._fileCommand(0x06, "%s\x00" % remoteDirName)
 		if ans[0] != 0:
 			print "Error delete directory:", ans
+			self.invalidateCache(remoteDirName.rsplit('/', 1)[0])
+		else:
+			self._cacheRemove(remoteDirName)
 		if ans[1:3] != (3, 13):
 			print "Warning: delete directory:", ans
 
 	def readDirectory(self, remoteDirName):
-		"""Reads a directory and yields a tuple (type, size, name) for each entry.
-		type is 1 for a regular file and 2 for a subdirectory."""
+		"""Reads a directory and returns the list of tuples (type, size, name)
+		for its entries. type is 1 for a regular file and 2 for a subdirectory.
+		The whole listing is read before returning, so that the directory
+		is never left open on the phone. The listing is cached, and kept
+		up to date as long as the directory is modified only by this object."""
+		key = remoteDirName.rstrip('/')
+		ents = self._dirCache.get(key)
+		if ents is not None:
+			return list(ents)
+		epoch = self._cacheEpoch
+		ents = []
 		ans = self._fileCommand(self._DIR_OPEN, "%s\x00" % remoteDirName)
 		if ans[0] < 0:
-			return
+			return []
 		if ans[1:3] != (3, 13):
 			print "Warning: open directory:", ans
 		while True:
@@ -341,63 +1234,364 @@ class SamsungWave:
 				if len(r[3]) > 0:
 					print "Warning: close directory:", ans
 				break
-			yield attr, size, name
+			ents.append((attr, size, name))
+		# don't cache the listing if something has been changed meanwhile
+		if epoch == self._cacheEpoch:
+			self._dirCache[key] = ents
+		return list(ents)
+
+	def walk(self, remoteDirName):
+		"""Like os.walk, yields a tuple (dirname, dirs, files) for remoteDirName
+		and each of its subdirectories, where dirs and files are lists of
+		entries as returned by readDirectory."""
+		ents = [ent for ent in self.readDirectory(remoteDirName) if not ent[2] in ('.', '..')]
+		yield remoteDirName, [ent for ent in ents if ent[0] == 2], [ent for ent in ents if ent[0] == 1]
+		for ent in ents:
+			if ent[0] == 2:
+				for w in self.walk(remoteDirName.rstrip('/') + '/' + ent[2]):
+					yield w
+
+	def stat(self, remotePath):
+		"""Return the entry (type, size, name) for remotePath,
+		or None if it does not exist."""
+		dirname, name = remotePath.rstrip('/').rsplit('/', 1)
+		for ent in self.readDirectory(dirname or '/'):
+			if ent[2] == name:
+				return ent
+		return None
+
+	def _invalidateApp(self, appId):
+		"""Forget the listings of the subfolders of the folder of application
+		appId, where the phone and the application write their files.
+		The listing of the folder itself, which is only changed
+		by the broker, is kept, see uploadedTree."""
+		prefix = '/Osp/Applications/%s/' % appId
+		self._cacheEpoch += 1
+		for d in self._dirCache.keys():
+			if d.startswith(prefix):
+				del self._dirCache[d]
+
+	def invalidateCache(self, remoteDirName = None):
+		"""Forget the listings of remoteDirName and everything below it,
+		or all listings, if remoteDirName is None."""
+		self._cacheEpoch += 1
+		if remoteDirName is None:
+			self._dirCache.clear()
+			return
+		key = remoteDirName.rstrip('/')
+		for d in self._dirCache.keys():
+			if d == key or d.startswith(key + '/'):
+				del self._dirCache[d]
+
+	def _cached(self, remotePath):
+		"""Return the cached entry for remotePath, False if the parent directory
+		is cached and remotePath is not there, or None if nothing is known."""
+		dirname, name = remotePath.rstrip('/').rsplit('/', 1)
+		ents = self._dirCache.get(dirname)
+		if ents is None:
+			return None
+		for ent in ents:
+			if ent[2] == name:
+				return ent
+		return False
 
-	def listFiles(self, remoteDirName):
-		for f in self.readDirectory(remoteDirName):
+	def _cacheSet(self, remotePath, attr, size):
+		dirname, name = remotePath.rstrip('/').rsplit('/', 1)
+		ents = self._dirCache.get(dirname)
+		if ents is not None:
+			ents[:] = [ent for ent in ents if ent[2] != name] + [(attr, size, name)]
+
+	def _cacheRemove(self, remotePath):
+		dirname, name = remotePath.rstrip('/').rsplit('/', 1)
+		self.invalidateCache(remotePath)
+		ents = self._dirCache.get(dirname)
+		if ents is not None:
+			ents[:] = [ent for ent in ents if ent[2] != name]
+
+	def listFiles(self, remoteDirName, recursive = False):
+		if not recursive:
+			self._printEntries(self.readDirectory(remoteDirName))
+			return
+		for dirname, dirs, files in self.walk(remoteDirName):
+			print '%s:' % dirname
+			self._printEntries(sorted(dirs + files, key = lambda ent: ent[2]))
+
+	def _printEntries(self, ents):
+		for f in ents:
 			if f[0] == 2:
 				t = '/'
 			else:
 				t = ''
 			print "%8d %s%s" % (f[1], f[2], t)
 
-def install(appid, exename):
-	wave = SamsungWave()
-	# TODO: The following commands should be used to determine
+# The crash reports and memory debugging files of an application, relative
+# to its folder, which are removed before it is installed again.
+# TODO: These paths look like someone did the concatenation the wrong way.
+# This is how the original Broker.exe does the thing,
+# and maybe we should fix it.
+CRASH_FILES = [
+	'Data/memdebug_report.txt',
+	'Data/Bin/core',
+	'Data/Bin/Bin/stackFrame.txt',
+	'Data/Bin/Bin/Bin/crashinfo.txt',
+	'Data/memdebug.ini',
+	'Bin/stackFrame.txt',
+	'Bin/stackFrame.txtcore',
+	'Bin/stackFrame.txtcorecrashinfo.txt' ]
+
+def pullCrash(wave, appid, localDir = None):
+	"""Download the files from CRASH_FILES which are there on the phone
+	to localDir (by default, appid-crash), keeping their paths relative
+	to the application folder. Return the number of files which could
+	not be downloaded."""
+	remotePrefix = '/Osp/Applications/' + appid + '/'
+	localDir = localDir or appid + '-crash'
+	# the application writes them behind the broker's back
+	wave.invalidateCache(remotePrefix)
+	found = []
+	for name in CRASH_FILES:
+		ent = wave.stat(remotePrefix + name)
+		if ent and ent[0] == 1:
+			found.append((name, ent[1]))
+	if not found:
+		print 'No crash reports of %s on the device' % appid
+		return 0
+	failed = 0
+	for name, size in found:
+		localName = os.path.join(localDir, *name.split('/'))
+		if not os.path.isdir(os.path.dirname(localName)):
+			os.makedirs(os.path.dirname(localName))
+		print 'get file %s -> %s (%d bytes)' % (remotePrefix + name, localName, size)
+		if not wave.getFile(localName, remotePrefix + name, size = size):
+			failed += 1
+	return failed
+
+def remoteTree(wave, remoteDirName):
+	"""List remoteDirName and all its subfolders on the phone. Return tuple
+	(dirs, files), where dirs is the set of the paths of the subfolders
+	relative to remoteDirName, and files maps the relative paths of the
+	files to their sizes, or None if remoteDirName does not exist."""
+	# even an empty folder has '.' and '..'
+	if not list(wave.readDirectory(remoteDirName)):
+		return None
+	dirs = set()
+	files = {}
+	for dirname, subdirs, dirfiles in wave.walk(remoteDirName):
+		prefix = dirname[len(remoteDirName) + 1:]
+		prefix = prefix + '/' if prefix else ''
+		dirs.update(prefix + ent[2] for ent in subdirs)
+		files.update((prefix + ent[2], ent[1]) for ent in dirfiles)
+	return dirs, files
+
+def uploadedTree(wave, remoteDirName, state):
+	"""Tell what is in remoteDirName on the phone from what has been
+	uploaded there before (state, a SyncState), listing only remoteDirName
+	itself. Return tuple (dirs, files, unknown), where dirs and files are
+	as returned by remoteTree, and unknown is the list of the CRASH_FILES
+	which may or may not be there, or None if the listing does not show
+	all the folders uploaded to remoteDirName. The subfolders are assumed
+	to have been left as they were uploaded, except for the crash reports,
+	which the phone writes behind our back, so they are only known if
+	their folders are in the cache."""
+	ents = dict((ent[2], ent) for ent in wave.readDirectory(remoteDirName))
+	if not ents:
+		return None
+	for name in state.dirs:
+		if not '/' in name and (ents.get(name) or (0,))[0] != 2:
+			return None
+	dirs = set(state.dirs)
+	dirs.update(name for name, ent in ents.items() if ent[0] == 2 and not name in ('.', '..'))
+	files = dict((name, info[0]) for name, info in state.files.items() if '/' in name)
+	files.update((name, ent[1]) for name, ent in ents.items() if ent[0] == 1)
+	unknown = []
+	for name in CRASH_FILES:
+		ent = wave._cached(remoteDirName + '/' + name)
+		if ent:
+			files[name] = ent[1]
+		elif ent is None:
+			unknown.append(name)
+	return dirs, files, unknown
+
+class InstallPlan:
+	"""The operations bringing the folder of application appid on the phone
+	up to date, worked out from what is there (remote, as returned by
+	remoteTree or uploadedTree), the catalog entry of the local folder (app)
+	and what has been uploaded before (state, a SyncState). Only the crash
+	reports that are there, and the files uploaded before that are gone
+	from the local folder, are deleted. The crash reports in unknown may
+	or may not be there, and deleting them is cheaper than listing their
+	folders, so they are deleted anyway. Only the missing folders are
+	created. Only the files that are missing, differ in size, or have
+	changed since they were uploaded are sent, all of them if full is True.
+
+	ops is the list of tuples (operation, remote path, path relative to the
+	application folder or None, estimated number of round trips), in the
+	order they are done in: 'clean' the crash reports which may be there,
+	'delete' files, 'rmdir' folders, deepest first, 'mkdir' folders,
+	parents first, and 'put' files. Every command is answered by the phone,
+	so the number of round trips is the number of commands, whether or not
+	they are pipelined."""
+
+	def __init__(self, appid, app, state, remote, chunkSize, full = False, unknown = ()):
+		self.appid = appid
+		self.ops = []
+		self.remotePrefix = '/Osp/Applications/' + appid + '/'
+		self._files = dict((name, (size, digest)) for name, (size, mtime, digest) in app['files'].items())
+		self._dirs = set(app['dirs'])
+		if remote is None:
+			remoteDirs, remoteFiles = set(), {}
+			# creating a folder which is there does no harm
+			for dirname in ['/Osp', '/Osp/Applications', self.remotePrefix[:-1]]:
+				self.ops.append(('mkdir', dirname, None, 1))
+		else:
+			remoteDirs, remoteFiles = remote
+		self._remoteDirs = remoteDirs
+		# unless the application comes with one of them
+		stale = set(name for name in CRASH_FILES if name in remoteFiles and not name in self._files)
+		stale.update(name for name in state.files if not name in self._files and name in remoteFiles)
+		# uploaded before, but gone from both sides
+		self._gone = [name for name in state.files if not name in self._files and not name in remoteFiles]
+		for name in unknown:
+			if name in CRASH_FILES and not name in self._files:
+				self._op('clean', name, 1)
+		for name in sorted(stale):
+			self._op('delete', name, 1)
+		for name in sorted(state.dirs - self._dirs, reverse = True):
+			if name in remoteDirs:
+				self._op('rmdir', name, 1)
+		for name in sorted(self._dirs - remoteDirs):
+			self._op('mkdir', name, 1)
+		self.unchanged = []
+		for name in sorted(self._files):
+			size = self._files[name][0]
+			if not full and remoteFiles.get(name) == size and state.files.get(name) == self._files[name]:
+				self.unchanged.append(name)
+				continue
+			offset = state.resumeOffset(name, self._files[name])
+			n = 2 + (size - offset + chunkSize - 1) // chunkSize
+			if offset:
+				# sendFile lists the folder again to see how much of the file is there
+				parent = name.rsplit('/', 1)[0] + '/' if '/' in name else ''
+				n += 5 + sum(1 for other in list(remoteDirs) + remoteFiles.keys()
+					if other.startswith(parent) and not '/' in other[len(parent):])
+			self._op('put', name, n)
+
+	def _op(self, op, name, n):
+		self.ops.append((op, self.remotePrefix + name, name, n))
+
+	def estimate(self):
+		return sum(op[3] for op in self.ops)
+
+	def show(self, how, listing):
+		"""Print the plan. how tells what it is based on, and listing
+		is the number of round trips finding that out has taken."""
+		print 'plan for %s from %s (listing took %d round trips):' % (self.appid, how, listing)
+		for op, remotePath, name, n in self.ops:
+			print '  %-6s %-64s %6d' % (op, remotePath, n)
+		print '  %d files unchanged' % len(self.unchanged)
+		print 'estimated %d round trips' % self.estimate()
+
+	def execute(self, wave, state):
+		"""Carry out the plan, keeping state up to date, and return
+		the number of round trips it has taken."""
+		start = wave.framesSent
+		# the folders which are there already were not in the state
+		# if the device has been set up elsewhere or with -f
+		state.dirs.update(self._dirs & self._remoteDirs)
+		for name in self._gone:
+			del state.files[name]
+		for op, remotePath, name, n in self.ops:
+			before = wave.framesSent
+			if op == 'clean':
+				wave.deleteFile(remotePath, missingOk = True)
+			elif op == 'delete':
+				print 'delete file %s' % remotePath
+				wave.deleteFile(remotePath)
+				state.files.pop(name, None)
+			elif op == 'rmdir':
+				print 'delete dir %s' % remotePath
+				wave.deleteDirectory(remotePath)
+				state.dirs.discard(name)
+			elif op == 'mkdir':
+				print 'create dir %s' % remotePath
+				wave.createDirectory(remotePath)
+				if name is not None:
+					state.dirs.add(name)
+			else:
+				localName = os.path.join(self.appid, name)
+				print 'put file %s -> %s' % (localName, remotePath)
+				info = self._files[name]
+				state.files.pop(name, None)
+				offset = state.resumeOffset(name, info)
+				state.partial = (name, info, offset)
+				def progress(acked):
+					state.partial = (name, info, acked)
+				if wave.sendFile(localName, remotePath, offset = offset, progress = progress):
+					state.files[name] = info
+				state.partial = None
+			if wave.framesSent - before != n:
+				print '%s %s took %d round trips, %d estimated' % (op, remotePath, wave.framesSent - before, n)
+		return wave.framesSent - start
+
+def planInstall(wave, appid, app, state, full = False):
+	"""Find out what is in the folder of appid on the phone, print
+	the InstallPlan for it and return it. If it has been installed
+	before, the folder itself is listed, and if it has the folders
+	uploaded last time, the rest is taken from state. Otherwise,
+	the whole folder is listed."""
+	start = wave.framesSent
+	remoteDirName = '/Osp/Applications/' + appid
+	remote = None
+	unknown = ()
+	if state.files and not full:
+		remote = uploadedTree(wave, remoteDirName, state)
+	if remote is not None:
+		remote, unknown = remote[:2], remote[2]
+		how = 'the folder and what has been uploaded before'
+	else:
+		remote = remoteTree(wave, remoteDirName)
+		how = 'the whole folder'
+	plan = InstallPlan(appid, app, state, remote, wave.chunkSize or wave._CHUNK_SIZE, full, unknown)
+	plan.show(how, wave.framesSent - start)
+	return plan
+
+def install(wave, appid, exename, full = False):
+	index = catalog.Catalog()
+	app = index.refresh(appid)
+	index.save()
+	# TODO: The LCD dimensions should be used to determine
 	# whether the application is likely to run on the connected device.
-	# For now we'll just exchange some messages to see if the
-	# device seems to support the protocol and we'll display some info.
-	print wave.getModel()
-	print wave.getLcdInfo()
-	# TODO: Compute the real total size of the app.
-	wave.isInstallationPossible(appid, 1048576)
+	# For now we'll just display them.
+	info = wave.preflight(appid, app['size'])
+	model = info['model']
+	print model
+	print info['lcd']
+	if info['userMem'] is not None and app['size'] > info['userMem']:
+		print 'Cannot install: %s takes %d bytes, the device has %d bytes of user memory' % (
+			appid, app['size'], info['userMem'])
+		return False
+	if info['possible'] is False:
+		print 'Cannot install: the device refuses to install %d bytes of %s' % (app['size'], appid)
+		return False
+	elif info['possible'] is None:
+		print 'Warning: the device has not told if it can install %s' % appid
+	if wave.chunkSize is None:
+		wave.chunkSize = loadChunkSize(model)
+		if wave.chunkSize:
+			print 'chunk size %d' % wave.chunkSize
 
 	wave.appTerminate(appid)
 
-	# TODO: These paths look like someone did the concatenation the wrong way.
-	# This is how the original Broker.exe does the thing,
-	# and maybe we should fix it.
-	for fil in [
-		"/Osp/Applications/" + appid + "/Data/memdebug_report.txt",
-		"/Osp/Applications/" + appid + "/Data/Bin/core",
-		"/Osp/Applications/" + appid + "/Data/Bin/Bin/stackFrame.txt",
-		"/Osp/Applications/" + appid + "/Data/Bin/Bin/Bin/crashinfo.txt",
-		"/Osp/Applications/" + appid + "/Data/memdebug.ini",
-		"/Osp/Applications/" + appid + "/Bin/stackFrame.txt",
-		"/Osp/Applications/" + appid + "/Bin/stackFrame.txtcore",
-		"/Osp/Applications/" + appid + "/Bin/stackFrame.txtcorecrashinfo.txt" ]:
-		wave.deleteFile(fil)
-
-	for dirname in [
-		'/Osp',
-		'/Osp/Applications',
-		'/Osp/Applications/' + appid ]:
-		print 'create dir %s' % dirname
-		wave.createDirectory(dirname)
-	
-	for dirname, dirnames, filenames in os.walk(appid):
-		for subdirname in dirnames:
-			localName = os.path.join(dirname, subdirname)
-			remoteName = '/Osp/Applications/' + dirname + '/' + subdirname
-			print 'create dir %s -> %s' % (localName, remoteName)
-			wave.createDirectory(remoteName)
-
-	for dirname, dirnames, filenames in os.walk(appid):
-		for filename in filenames:
-			localName = os.path.join(dirname, filename)
-			remoteName = '/Osp/Applications/' + dirname + '/' + filename
-			print 'put file %s -> %s' % (localName, remoteName)
-			wave.sendFile(localName, remoteName)
+	# Only send what is not on the device as it is here.
+	state = SyncState(info['serial'] or model or 'unknown', appid)
+	if full:
+		state.forget()
+	plan = planInstall(wave, appid, app, state, full)
+	try:
+		n = plan.execute(wave, state)
+	finally:
+		state.save()
+	print 'done in %d round trips (%d estimated)' % (n, plan.estimate())
 
 	res = wave.appInstall(appid)
 	if res:
@@ -405,42 +1599,797 @@ def install(appid, exename):
 	else:
 		print 'Failed to install'
 
-	res = wave.appRun(appid, exename)
+	wave.appRun(appid, exename)
+	return res
+
+def loadChunkSize(model):
+	"""Return the chunk size found best for the model by tune-chunk,
+	or None if it has not been tuned."""
 	try:
-		while True:
-			q = wave._receive('debug', 'debug');
-			if q:
-				print string.strip(q)
+		d = json.load(open(os.path.join(STATE_DIR, 'chunksize.json')))
+	except (IOError, ValueError):
+		return None
+	return d.get(model, {}).get('chunkSize')
+
+def saveChunkSize(model, chunkSize, results):
+	"""Remember chunkSize as the best for the model, together with
+	the throughput measured for each size tried."""
+	fileName = os.path.join(STATE_DIR, 'chunksize.json')
+	try:
+		d = json.load(open(fileName))
+	except (IOError, ValueError):
+		d = {}
+	d[model] = { 'chunkSize': chunkSize, 'throughput': dict((str(k), v) for k, v in results.items()) }
+	if not os.path.isdir(STATE_DIR):
+		os.makedirs(STATE_DIR)
+	json.dump(d, open(fileName + '.tmp', 'w'), indent = 1, sort_keys = True)
+	os.rename(fileName + '.tmp', fileName)
+
+def tuneChunkSize(wave, sizes = None, trials = 3):
+	"""Upload a scratch file to the phone in chunks of each of the given
+	sizes, from the smallest one until a size fails, and check that
+	the whole file has made it. Return tuple (best, results), where best
+	is the size giving the highest throughput among those which worked
+	in all trials, or None, and results maps each size tried to its
+	throughput in bytes per second, or None if it failed."""
+	sizes = sorted(sizes or SamsungWave._PROBE_SIZES)
+	remote = '/Osp/bada-broker-probe.bin'
+	wave.createDirectory('/Osp')
+	fd, local = tempfile.mkstemp(prefix = 'bada-broker-probe')
+	os.close(fd)
+	results = {}
+	try:
+		for size in sizes:
+			nbytes = max(256 << 10, 8 * size)
+			f = open(local, 'wb')
+			f.write(os.urandom(nbytes))
+			f.close()
+			elapsed = 0.0
+			for i in range(trials):
+				start = time.time()
+				try:
+					ok = wave._sendFile(local, remote, wave.window, 0, None, size)
+				except TimeoutError:
+					ok = False
+				elapsed += time.time() - start
+				# the phone has to have all of it, not just acknowledge it
+				wave.invalidateCache('/Osp')
+				ent = wave.stat(remote) if ok else None
+				if not ent or ent[1] != nbytes:
+					wave._drain('cmd', 'raw')
+					elapsed = None
+					break
+			results[size] = nbytes * trials / elapsed if elapsed else None
+			print '%6d bytes: %s' % (size, '%.1f kB/s' % (results[size] / 1024) if results[size] else 'failed')
+			if not results[size]:
+				break
+	finally:
+		os.unlink(local)
+		wave.invalidateCache('/Osp')
+		wave.deleteFile(remote)
+	good = [size for size in results if results[size]]
+	return (max(good, key = results.get) if good else None), results
+
+def reconnect(connect, attempts = 30):
+	"""Wait for the phone to show up again and return a new SamsungWave
+	created with connect()."""
+	for i in range(attempts):
+		try:
+			return connect()
+		except (serial.SerialException, EnvironmentError):
+			time.sleep(1)
+	raise ConnectionLostError('device did not come back')
+
+def resumableInstall(wave, connect, appid, exename, full = False, retries = 3):
+	"""Run install(), and if the connection to the phone drops, reconnect
+	using connect() and carry on from the last chunk acknowledged by the phone.
+	Return tuple (result, wave), where wave is the SamsungWave in use
+	at the end."""
+	while True:
+		try:
+			return install(wave, appid, exename, full), wave
+		except (ConnectionLostError, TimeoutError), err:
+			if not retries:
+				raise
+			retries -= 1
+			print 'Connection lost (%s), reconnecting' % err.msg
+			if wave.stats:
+				wave.stats.count('reconnects')
+			wave.close()
+			wave = reconnect(connect)
+			# whatever has been forgotten is already in the sync state again
+			full = False
+
+class DebugSink:
+	"""Writes the debug messages of the application to out in batches,
+	so that the broker keeps up with a chatty application. Messages can be
+	prefixed with the time they have been received, and filtered by
+	a substring and/or a regular expression they must contain."""
+	# write at least every BATCH messages or INTERVAL seconds
+	BATCH = 256
+	INTERVAL = 0.2
+
+	def __init__(self, out, timestamps = False, substring = None, pattern = None):
+		self._out = out
+		self._timestamps = timestamps
+		self._substring = substring
+		self._pattern = re.compile(pattern) if pattern else None
+		self._lines = []
+		self._flushed = time.time()
+		self.written = 0
+		self.filtered = 0
+
+	def add(self, msgs):
+		now = time.time()
+		prefix = ''
+		if self._timestamps:
+			prefix = time.strftime('%H:%M:%S', time.localtime(now)) + '.%03d ' % (now * 1000 % 1000)
+		for m in msgs:
+			m = m.strip()
+			if (self._substring and not self._substring in m) or \
+					(self._pattern and not self._pattern.search(m)):
+				self.filtered += 1
+				continue
+			self._lines.append(prefix + m + '\n')
+		if len(self._lines) >= self.BATCH or now - self._flushed >= self.INTERVAL:
+			self.flush()
+
+	def flush(self):
+		if self._lines:
+			self.written += len(self._lines)
+			self._out.write(''.join(self._lines))
+			self._lines = []
+		self._out.flush()
+		self._flushed = time.time()
+
+def tailDebug(wave, sink, stop = None):
+	"""Pass the debug messages from the phone to sink until stop()
+	returns True, or forever if stop is not given."""
+	try:
+		while not (stop and stop()):
+			msgs = wave._receiveAll('debug', 'debug', DebugSink.INTERVAL)
+			if msgs:
+				sink.add(msgs)
+			else:
+				sink.flush()
+	finally:
+		sink.flush()
+		for (port, channel), n in sorted(wave.dropped().items()):
+			sys.stderr.write('Warning: %d messages dropped on %s channel of %s port\n' % (n, channel, port))
+
+def printDebug(wave, sink = None):
+	try:
+		tailDebug(wave, sink or DebugSink(sys.stdout))
+	except KeyboardInterrupt:
+		print 'Exiting due to keyboard interrupt'
+
+def discoverDevices():
+	"""Find the phones connected to this computer and return a list of
+	tuples (command port, debug port), one for each phone. Each phone
+	shows up as a USB device with (at least) two ACM interfaces,
+	the first of which is the command port."""
+	byDevice = {}
+	for tty in glob.glob('/sys/class/tty/ttyACM*'):
+		iface = os.path.realpath(os.path.join(tty, 'device'))
+		byDevice.setdefault(os.path.dirname(iface), []).append(
+			(os.path.basename(iface), '/dev/' + os.path.basename(tty)))
+	if byDevice:
+		return [tuple(name for iface, name in sorted(ports)[:2])
+			for usbdev, ports in sorted(byDevice.items()) if len(ports) >= 2]
+	# no sysfs, assume the ports of each phone are numbered consecutively
+	names = sorted(glob.glob('/dev/ttyACM*'), key = lambda n: int(re.sub('[^0-9]', '', n) or 0))
+	return zip(names[0::2], names[1::2])
+
+class FleetOutput(object):
+	"""Stands in for sys.stdout while installing on many devices at once,
+	and prefixes each line with the name of the device whose worker
+	thread printed it."""
+	def __init__(self, out):
+		self._out = out
+		self._lock = threading.Lock()
+		self._local = threading.local()
+
+	# the print statement keeps its state in the file object,
+	# so each thread needs its own
+	def _getSoftspace(self):
+		return getattr(self._local, 'softspace', 0)
+
+	def _setSoftspace(self, value):
+		self._local.softspace = value
+
+	softspace = property(_getSoftspace, _setSoftspace)
+
+	def setPrefix(self, prefix):
+		self._local.prefix = prefix
+		self._local.line = ''
+
+	def write(self, s):
+		prefix = getattr(self._local, 'prefix', None)
+		if prefix is None:
+			with self._lock:
+				self._out.write(s)
+			return
+		lines = (self._local.line + s).split('\n')
+		self._local.line = lines.pop()
+		if lines:
+			with self._lock:
+				self._out.write(''.join('%s: %s\n' % (prefix, l) for l in lines))
+
+	def flush(self):
+		with self._lock:
+			self._out.flush()
+
+def fleetInstall(devices, appid, exename, full = False, window = SamsungWave._WINDOW, trace = None, stats = None,
+		chunkSize = None, retries = 3, **options):
+	"""Install the application on all devices at the same time, one worker
+	thread per device, then print a summary. trace is a function returning
+	a Trace object for the device with the given index, or None.
+	If stats is given, the numbers from all devices are collected in it.
+	window, chunkSize and retries are used as by install and resumableInstall,
+	and the other options are passed to SamsungWave, e.g. capacity and overflow.
+	Return True if the app has been installed on all devices."""
+	results = [None] * len(devices)
+	out = FleetOutput(sys.stdout)
+
+	def worker(i, port, debugPort):
+		out.setPrefix(port)
+		res = { 'port': port, 'model': None, 'lcd': None, 'status': 'failed',
+			'connect': 0.0, 'install': 0.0 }
+		results[i] = res
+		t = time.time()
+		wave = None
+		tr = trace(i) if trace else None
+		try:
+			def connect():
+				wave = SamsungWave(port, debugPort, tr, stats = stats, **options)
+				wave.window = window
+				wave.chunkSize = chunkSize
+				return wave
+			wave = connect()
+			res['model'] = wave.getModel()
+			res['lcd'] = wave.getLcdInfo()
+			res['connect'] = time.time() - t
+			t = time.time()
+			ok, wave = resumableInstall(wave, connect, appid, exename, full, retries)
+			if ok:
+				res['status'] = 'installed'
+			res['install'] = time.time() - t
+		except Exception, err:
+			res['status'] = 'error: %s' % (getattr(err, 'msg', None) or str(err) or err.__class__.__name__)
+			print res['status']
+		finally:
+			if wave:
+				wave.close()
+			if tr:
+				tr.close()
+				print tr.summary(),
+
+	start = time.time()
+	threads = [threading.Thread(target = worker, args = (i,) + dev) for i, dev in enumerate(devices)]
+	sys.stdout = out
+	try:
+		for t in threads:
+			t.start()
+		for t in threads:
+			t.join()
+	finally:
+		sys.stdout = out._out
+
+	print '%-14s %-12s %-10s %9s %9s  %s' % ('port', 'model', 'lcd', 'connect', 'install', 'status')
+	for res in results:
+		print '%-14s %-12s %-10s %8.2fs %8.2fs  %s' % (res['port'], res['model'],
+			'%sx%s' % res['lcd'] if res['lcd'] else None, res['connect'], res['install'], res['status'])
+	print '%d devices in %.2fs' % (len(devices), time.time() - start)
+	return all(res['status'] == 'installed' for res in results)
+
+# the number of arguments the commands cannot do without
+_MIN_ARGS = { 'install': 2, 'fleet-install': 2, 'plan': 1, 'get': 1, 'pull-crash': 1 }
+
+def missingArguments(args):
+	"""Return True if the command given as a list of command line
+	arguments lacks some of them."""
+	return bool(args) and len(args) - 1 < _MIN_ARGS.get(args[0], 0)
+
+def runCommand(wave, connect, args, full = False, retries = 3):
+	"""Run one of the commands operating on a single phone, given as
+	a list of command line arguments. Return tuple (exit code, wave),
+	where wave is the SamsungWave in use at the end."""
+	if args[0] == 'rmdir':
+		for dirname in args[1:]:
+			wave.deleteDirectory(dirname)
+	elif args[0] == 'ls':
+		recursive = args[1:2] == ['-R']
+		for dirname in args[1 + recursive:]:
+			print 'Files in %s:' % dirname
+			wave.listFiles(dirname, recursive)
+	elif args[0] == 'rm':
+		for filename in args[1:]:
+			wave.deleteFile(filename)
+	elif args[0] == 'install':
+		res, wave = resumableInstall(wave, connect, args[1], args[2], full, retries)
+		if not res:
+			return 1, wave
+	elif args[0] == 'plan':
+		index = catalog.Catalog()
+		app = index.refresh(args[1])
+		index.save()
+		model = wave.getModel()
+		state = SyncState(wave.getSerialNumber() or model or 'unknown', args[1])
+		if full:
+			state.forget()
+		if wave.chunkSize is None:
+			wave.chunkSize = loadChunkSize(model)
+		planInstall(wave, args[1], app, state, full)
+	elif args[0] == 'get':
+		localName = args[2] if len(args) > 2 else args[1].rsplit('/', 1)[-1]
+		if not wave.getFile(localName, args[1]):
+			return 1, wave
+	elif args[0] == 'pull-crash':
+		if pullCrash(wave, args[1], args[2] if len(args) > 2 else None):
+			return 1, wave
+	elif args[0] == 'tune-chunk':
+		model = wave.getModel()
+		best, results = tuneChunkSize(wave, [int(a, 0) for a in args[1:]])
+		if not best:
+			print 'Error: no chunk size works'
+			return 1, wave
+		saveChunkSize(model, best, results)
+		wave.chunkSize = best
+		print 'Chunk size for %s: %d' % (model, best)
+	return 0, wave
+
+SOCKET_NAME = 'broker.sock'
+
+class SocketOutput:
+	"""Stands in for sys.stdout while the daemon runs a command,
+	and sends whatever is printed to the client. If the client goes away,
+	the output is dropped, but the command is not interrupted."""
+	def __init__(self, conn):
+		self._conn = conn
+		self.softspace = 0
+		self.closed = False
+
+	def send(self, **msg):
+		if self.closed:
+			return
+		try:
+			self._conn.sendall(json.dumps(msg) + '\n')
+		except socket.error:
+			self.closed = True
+
+	def write(self, s):
+		# latin-1 passes any bytes the phone sends through JSON unchanged
+		if isinstance(s, str):
+			s = s.decode('latin-1')
+		self.send(out = s)
+
+	def flush(self):
+		pass
+
+class BrokerDaemon:
+	"""Keeps the session with the phone open between commands, which
+	are sent by bada-broker clients over a Unix socket, one request
+	per connection. The request is a JSON object with the command line
+	arguments, options and working directory of the client. The reply
+	is a stream of JSON objects, one per line, with the output of
+	the command, the last of which carries its exit code."""
+	COMMANDS = ['install', 'plan', 'ls', 'rm', 'rmdir', 'get', 'pull-crash', 'debug-tail', 'tune-chunk']
+
+	def __init__(self, connect, socketPath):
+		self._connect = connect
+		self._socketPath = socketPath
+		self._wave = None
+		self._stats = None
+
+	def serve(self):
+		"""Serve requests until interrupted. Return False if another
+		daemon is already listening on the socket."""
+		if os.path.exists(self._socketPath):
+			if forward(self._socketPath, None) is not None:
+				print 'Error: broker daemon already listening on %s' % self._socketPath
+				return False
+			# left behind by a daemon which has been killed
+			os.unlink(self._socketPath)
+		dirName = os.path.dirname(self._socketPath)
+		if dirName and not os.path.isdir(dirName):
+			os.makedirs(dirName)
+		self._listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		self._listener.bind(self._socketPath)
+		self._listener.listen(4)
+		print 'Listening on %s' % self._socketPath
+		try:
+			self._wave = self._connect()
+			self._stats = self._wave.stats
+			while True:
+				conn, addr = self._listener.accept()
+				try:
+					self._handle(conn)
+				finally:
+					conn.close()
+		except KeyboardInterrupt:
+			print 'Exiting due to keyboard interrupt'
+		finally:
+			self._listener.close()
+			os.unlink(self._socketPath)
+			if self._wave:
+				self._wave.close()
+		return True
+
+	def _handle(self, conn):
+		try:
+			line = conn.makefile('r').readline()
+		except socket.error:
+			return
+		if not line:
+			return
+		out = SocketOutput(conn)
+		try:
+			request = json.loads(line)
+			# the frames sent to the phone are made of byte strings
+			args = [a.encode('utf-8') for a in request.get('args') or ['']]
+		except (ValueError, AttributeError, TypeError), err:
+			out.send(out = 'Error: invalid request: %s\n' % str(err), exit = 1)
+			return
+		if args[0] == 'ping':
+			out.send(exit = 0)
+			return
+		if not args[0] in self.COMMANDS:
+			out.send(out = 'Error: unknown command: %s\n' % args[0], exit = 1)
+			return
+		# any client may connect to the socket, so the options
+		# are checked and clamped the same way as by main
+		try:
+			window = self._option(request, 'window', SamsungWave._WINDOW, 1, SamsungWave._RESPONSE_CAPACITY)
+			chunkSize = self._option(request, 'chunkSize', None, 1, SamsungWave._MAX_CHUNK_SIZE)
+			retries = self._option(request, 'retries', 3, 0)
+		except TypeError, err:
+			out.send(out = 'Error: invalid request: %s\n' % str(err), exit = 2)
+			return
+		if missingArguments(args):
+			out.send(out = 'Error: %s: missing arguments\n' % args[0], exit = 2)
+			return
+		print 'Running %s' % ' '.join(args)
+		code = 1
+		stdout = sys.stdout
+		sys.stdout = out
+		# the numbers requested by the client are collected separately,
+		# and then added to those of the daemon
+		stats = Stats() if request.get('stats') else None
+		def connect():
+			wave = self._connect()
+			self._stats = wave.stats
+			if stats:
+				wave.stats = stats
+			return wave
+		try:
+			os.chdir(request.get('cwd', u'/').encode('utf-8'))
+			if not self._wave:
+				self._wave = reconnect(connect)
+			elif stats:
+				self._wave.stats = stats
+			if args[0] != 'debug-tail':
+				self._wave.window = window
+				# unless given by the client, install looks up the tuned one again
+				self._wave.chunkSize = chunkSize
+				code, self._wave = runCommand(self._wave, connect, args,
+					request.get('full', False), retries)
+			else:
+				code = 0
+			if args[0] in ('install', 'debug-tail') and code == 0:
+				self._tail(conn, out, request)
+		except (ConnectionLostError, TimeoutError, serial.SerialException), err:
+			print 'Error: %s' % (getattr(err, 'msg', None) or str(err))
+			# start over with a new session on the next request
+			if self._wave:
+				self._wave.close()
+				self._wave = None
+		except Exception, err:
+			print 'Error: %s' % (getattr(err, 'msg', None) or str(err) or err.__class__.__name__)
+		finally:
+			sys.stdout = stdout
+			if stats:
+				if self._wave:
+					self._wave.stats = self._stats
+				if self._stats:
+					self._stats.merge(stats)
+				out.send(stats = stats.toDict())
+		out.send(exit = code)
+
+	def _option(self, request, name, default, low, high = None):
+		"""Return the integer option name of the request, or default
+		if it is not given, brought within low and high. Raise TypeError
+		if it is not an integer."""
+		value = request.get(name)
+		if value is None:
+			return default
+		if isinstance(value, bool) or not isinstance(value, (int, long)):
+			raise TypeError('%s is not an integer: %r' % (name, value))
+		value = max(low, value)
+		return value if high is None else min(value, high)
+
+	def _tail(self, conn, out, request):
+		"""Print debug messages until the client disconnects or another
+		client wants to talk to the phone."""
+		def stop():
+			if out.closed:
+				return True
+			r = select.select([conn, self._listener], [], [], 0)[0]
+			return self._listener in r or (conn in r and not conn.recv(1))
+		debugLog = request.get('debugLog')
+		log = open(debugLog, 'a') if debugLog and debugLog != '-' else None
+		try:
+			tailDebug(self._wave, DebugSink(log or out, debugLog is not None,
+				request.get('filter'), request.get('filterRe')), stop)
+		finally:
+			if log:
+				log.close()
+
+def forward(socketPath, args, statsFile = None, **options):
+	"""Send the command to the broker daemon listening on socketPath
+	and print its output. Return the exit code of the command,
+	or None if there is no daemon. If args is None, only check
+	if the daemon is there. If options include stats, the numbers
+	collected while running the command are written to statsFile."""
+	conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	try:
+		conn.connect(socketPath)
+	except socket.error:
+		conn.close()
+		return None
+	try:
+		request = dict(options, args = args or ['ping'], cwd = os.getcwd())
+		conn.sendall(json.dumps(request) + '\n')
+		for line in conn.makefile('r'):
+			msg = json.loads(line)
+			if 'out' in msg:
+				sys.stdout.write(msg['out'].encode('latin-1'))
+				sys.stdout.flush()
+			if 'stats' in msg:
+				writeStats(Stats.fromDict(msg['stats']), options.get('stats'), statsFile)
+			if 'exit' in msg:
+				return msg['exit']
+		print 'Error: broker daemon disconnected'
+		return 1
 	except KeyboardInterrupt:
 		print 'Exiting due to keyboard interrupt'
-	return 
+		return 0
+	finally:
+		conn.close()
+
+def usage():
+	print '''Usage:
+ {0} [options] install app_id exe_name
+ {0} [options] plan app_id
+ {0} [options] fleet-install app_id exe_name
+ {0} [options] ls [-R] remote_dir...
+ {0} [options] rm remote_file...
+ {0} [options] rmdir remote_dir...
+ {0} [options] get remote_file [local_file]
+ {0} [options] pull-crash app_id [local_dir]
+ {0} [options] debug-tail
+ {0} [options] tune-chunk [size...]
+ {0} [options] daemon
+ {0} dump-trace trace_file
+
+Options:
+ -p,  --port=dev         Command port of the device (default: /dev/ttyACM0).
+ -d,  --debug-port=dev   Debug port of the device (default: /dev/ttyACM1).
+ -f,  --full             Send all files of the application, even those
+                         which have not changed since the last install.
+ -t,  --trace=level      Record the communication with the device:
+                         off (default), summary (print the number of
+                         bytes exchanged), or full (also capture the
+                         data to a file, to be printed with dump-trace).
+      --trace-file=fn    Capture file name (default: broker.trace).
+ -r,  --retries=n        Reconnect and resume the installation up to n
+                         times if the connection drops (default: 3).
+ -S,  --stats=format     Print the round trip times of each kind of command,
+                         the numbers of bytes and messages exchanged,
+                         retries, timeouts, and throughput of each file
+                         uploaded or downloaded, as a summary or json.
+      --stats-file=fn    Write the numbers to fn instead of stderr.
+ -c,  --chunk-size=n     Send files in chunks of n bytes, instead of
+                         {4} or the size chosen by tune-chunk.
+ -w,  --window=n         Send up to n file chunks ahead of their
+                         acknowledgements, and up to n reads ahead of
+                         the chunks they return (default: {1}).
+                         1 disables pipelining.
+ -l,  --debug-log=fn     Append the debug messages printed after install
+                         and by debug-tail to fn instead of the console,
+                         with the time they have been received.
+                         - prints them to the console with the time.
+      --filter=text      Print only the debug messages containing text.
+      --filter-re=regex  Print only the debug messages matching regex.
+ -b,  --buffer=n         Keep up to n messages received on each channel
+                         of the device until they are processed
+                         (default: {3}).
+      --overflow=policy  What to do with the messages received when
+                         the buffer is full: drop-oldest (default)
+                         or drop-newest.
+ -s,  --socket=path      Unix socket of the broker daemon
+                         (default: {2}).
+ -n,  --no-daemon        Talk to the device directly, even if
+                         the broker daemon is running.
+
+Before uploading anything, install finds out what is in the application
+folder on the device and prints the plan: the files and folders to delete,
+the folders to create and the files to upload, with the number of round
+trips each is estimated to take. If the folders uploaded by the last
+install are there, only the application folder itself is listed, and the
+rest is assumed to be as it has been uploaded. Otherwise, or with -f,
+everything in it is listed. plan only prints the plan.
+
+pull-crash downloads the core dump, stack frame, crash info and memory
+debugging reports the application has left on the device to local_dir
+(default: app_id-crash).
+
+tune-chunk sends a scratch file in chunks of increasing size (by default
+from {4} to {5} bytes), and remembers the one giving the best throughput
+for the model of the device, to be used by later installs.
+
+The daemon command keeps the session with the device open and runs
+the install, plan, ls, rm, rmdir, get, pull-crash, debug-tail and
+tune-chunk commands sent to the socket by other invocations of {0},
+which then only print the results. They talk to the device directly
+if any of -p, -d, -t, -b and --overflow is given, as these only apply
+to a new session.'''.format(
+	sys.argv[0], SamsungWave._WINDOW, os.path.join(STATE_DIR, SOCKET_NAME), ChannelBuffer().capacity,
+	SamsungWave._CHUNK_SIZE, SamsungWave._MAX_CHUNK_SIZE)
 
 def main():
-	if len(sys.argv) >= 2:
-		if sys.argv[1] == 'rmdir':
-			wave = SamsungWave()
-			for dirname in sys.argv[2:]:
-				wave.deleteDirectory(dirname)
-			exit(0)
-		elif sys.argv[1] == 'ls':
-			wave = SamsungWave()
-			for dirname in sys.argv[2:]:
-				print 'Files in %s:' % dirname
-				wave.listFiles(dirname)
-			exit(0)
-		elif sys.argv[1] == 'rm':
-			wave = SamsungWave()
-			for filename in sys.argv[2:]:
-				wave.deleteFile(filename)
-			exit(0)
-		elif sys.argv[1] == 'install':
-			install(sys.argv[2], sys.argv[3])
-			exit(0)
-		else:
-			print 'Error: unknown command: %s' % sys.argv[1]
+	try:
+		opts, args = getopt.getopt(sys.argv[1:], "hp:d:fr:t:S:c:w:l:b:s:n",
+			["help", "port=", "debug-port=", "full", "retries=", "trace=", "trace-file=",
+			"stats=", "stats-file=", "chunk-size=", "window=",
+			"debug-log=", "filter=", "filter-re=", "buffer=", "overflow=", "socket=", "no-daemon"])
+	except getopt.GetoptError, err:
+		sys.stderr.write('%s: %s\n' % (sys.argv[0], str(err)))
+		sys.exit(2)
+	window = SamsungWave._WINDOW
+	chunkSize = None
+	full = False
+	retries = 3
+	ports = {}
+	traceLevel = Trace.OFF
+	traceFile = 'broker.trace'
+	statsFormat = None
+	statsFile = None
+	socketPath = os.path.join(STATE_DIR, SOCKET_NAME)
+	useDaemon = True
+	debugLog = None
+	debugFilter = None
+	debugFilterRe = None
+	for o, a in opts:
+		if o in ('-h', '--help'):
+			usage()
+			sys.exit()
+		elif o in ('-p', '--port'):
+			ports['port'] = a
+		elif o in ('-d', '--debug-port'):
+			ports['debugPort'] = a
+		elif o in ('-f', '--full'):
+			full = True
+		elif o in ('-r', '--retries'):
+			retries = int(a)
+		elif o in ('-t', '--trace'):
+			if not a in Trace.LEVELS:
+				sys.stderr.write('%s: invalid trace level: %s\n' % (sys.argv[0], a))
+				sys.exit(2)
+			traceLevel = Trace.LEVELS[a]
+		elif o == '--trace-file':
+			traceFile = a
+		elif o in ('-S', '--stats'):
+			if not a in Stats.FORMATS:
+				sys.stderr.write('%s: invalid stats format: %s\n' % (sys.argv[0], a))
+				sys.exit(2)
+			statsFormat = a
+		elif o == '--stats-file':
+			statsFile = a
+		elif o in ('-c', '--chunk-size'):
+			chunkSize = min(max(1, int(a, 0)), SamsungWave._MAX_CHUNK_SIZE)
+		elif o in ('-w', '--window'):
+			window = min(max(1, int(a)), SamsungWave._RESPONSE_CAPACITY)
+		elif o in ('-l', '--debug-log'):
+			debugLog = a
+		elif o == '--filter':
+			debugFilter = a
+		elif o == '--filter-re':
+			try:
+				re.compile(a)
+			except re.error, err:
+				sys.stderr.write('%s: invalid regular expression: %s\n' % (sys.argv[0], str(err)))
+				sys.exit(2)
+			debugFilterRe = a
+		elif o in ('-b', '--buffer'):
+			ports['capacity'] = max(1, int(a))
+		elif o == '--overflow':
+			if not a in ChannelBuffer.POLICIES:
+				sys.stderr.write('%s: invalid overflow policy: %s\n' % (sys.argv[0], a))
+				sys.exit(2)
+			ports['overflow'] = ChannelBuffer.POLICIES[a]
+		elif o in ('-s', '--socket'):
+			socketPath = a
+		elif o in ('-n', '--no-daemon'):
+			useDaemon = False
+	if len(args) >= 1 and args[0] == 'dump-trace':
+		for fileName in args[1:]:
+			dumpTrace(fileName)
+		exit(0)
+	if missingArguments(args):
+		sys.stderr.write('%s: %s: missing arguments\n' % (sys.argv[0], args[0]))
+		sys.stderr.write('invoke %s -h to get usage information\n' % sys.argv[0])
+		sys.exit(2)
+	# the daemon's session cannot be given other ports, buffers or trace
+	if useDaemon and not ports and traceLevel == Trace.OFF and \
+			len(args) >= 1 and args[0] in BrokerDaemon.COMMANDS:
+		code = forward(socketPath, args, statsFile, stats = statsFormat,
+			full = full, window = window, chunkSize = chunkSize, retries = retries,
+			debugLog = debugLog,
+			filter = debugFilter, filterRe = debugFilterRe)
+		if code is not None:
+			exit(code)
+	stats = None
+	if statsFormat:
+		stats = Stats()
+		ports['stats'] = stats
+	if len(args) >= 1:
+		if args[0] == 'fleet-install':
+			devices = discoverDevices()
+			if not devices:
+				print 'Error: no devices found'
+				exit(1)
+			traceFactory = None
+			if traceLevel != Trace.OFF:
+				traceFactory = lambda i: Trace(traceLevel, '%s.%d' % (traceFile, i))
+			# each device has its own ports, but the same buffers
+			options = dict((k, v) for k, v in ports.items() if k in ('capacity', 'overflow'))
+			ok = fleetInstall(devices, args[1], args[2], full, window, traceFactory, stats,
+				chunkSize, retries, **options)
+			if stats:
+				writeStats(stats, statsFormat, statsFile)
+			exit(0 if ok else 1)
+		if not args[0] in BrokerDaemon.COMMANDS + ['daemon']:
+			print 'Error: unknown command: %s' % args[0]
 			exit(1)
-		print 'WTF!'
-		exit(1)
+		# fleet-install has a trace for each device instead
+		trace = None
+		if traceLevel != Trace.OFF:
+			trace = Trace(traceLevel, traceFile)
+			ports['trace'] = trace
+		def connect():
+			wave = SamsungWave(**ports)
+			wave.window = window
+			wave.chunkSize = chunkSize
+			return wave
+		if args[0] == 'daemon':
+			try:
+				ok = BrokerDaemon(connect, socketPath).serve()
+			finally:
+				if trace:
+					trace.close()
+					sys.stderr.write(trace.summary())
+				if stats:
+					writeStats(stats, statsFormat, statsFile)
+			exit(0 if ok else 1)
+		wave = connect()
+		log = None
+		try:
+			code, wave = runCommand(wave, connect, args, full, retries)
+			if args[0] in ('install', 'debug-tail') and code == 0:
+				if debugLog and debugLog != '-':
+					log = open(debugLog, 'a')
+				printDebug(wave, DebugSink(log or sys.stdout, debugLog is not None,
+					debugFilter, debugFilterRe))
+		finally:
+			if log:
+				log.close()
+			wave.close()
+			if trace:
+				trace.close()
+				sys.stderr.write(trace.summary())
+			if stats:
+				writeStats(stats, statsFormat, statsFile)
+		exit(code)
 
 if __name__ == "__main__":
 	main()
@@ -0,0 +1,147 @@
+#!/usr/bin/python
+
+# buildcache - cache of the files generated by bada-genhtb, bada-signing
+# and bada-package
+# Copyright (C) 2012 Adrian Matoga
+#
+# bali-sdk is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# bali-sdk is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with bali-sdk.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import struct
+import hashlib
+import tempfile
+from os import path
+
+CACHE_DIR = os.environ.get('BADA_CACHE_DIR') or path.expanduser('~/.bada-cache')
+MAX_SIZE = 64 << 20
+# bump to invalidate entries written by older versions
+VERSION = '2'
+
+CHUNK_SIZE = 1 << 20
+
+def readChunks(fileName, buf = None):
+	"""Read fileName into buf, a bytearray (by default, a new one of
+	CHUNK_SIZE bytes), and yield a memoryview of each chunk read. The chunk is
+	only valid until the next one is read into the same buffer."""
+	if buf is None:
+		buf = bytearray(CHUNK_SIZE)
+	view = memoryview(buf)
+	f = open(fileName, 'rb')
+	try:
+		while True:
+			n = f.readinto(buf)
+			if not n:
+				break
+			yield view[:n]
+	finally:
+		f.close()
+
+def fileDigest(fileName, algorithm = hashlib.md5):
+	"""Return the digest of the contents of fileName. The cache only
+	tells files apart, so by default the fastest hash function available
+	is used."""
+	h = algorithm()
+	for chunk in readChunks(fileName):
+		h.update(chunk)
+	return h.digest()
+
+class BuildCache:
+	"""Content-addressed cache of files generated from other files.
+	Each entry is a file named after the digest of the inputs, holding
+	the contents of all outputs, each preceded by its length. The entries
+	are only ever read as data, so a cache shared with others cannot make
+	anything run here. When the cache grows beyond maxSize bytes,
+	the least recently used entries are removed. Errors are ignored,
+	so that a broken cache only costs the time to generate the files."""
+
+	def __init__(self, directory = None, maxSize = MAX_SIZE):
+		self.directory = directory or CACHE_DIR
+		self.maxSize = maxSize
+
+	def key(self, stage, inputs, *extra):
+		"""Return the key of the outputs of stage generated from
+		the files in inputs and the strings in extra."""
+		h = hashlib.sha1()
+		for s in [VERSION, stage] + [fileDigest(f) for f in inputs] + list(extra):
+			h.update('%d:%s' % (len(s), s))
+		return h.hexdigest()
+
+	def get(self, key):
+		"""Return the list of outputs stored under key, or None."""
+		entry = path.join(self.directory, key)
+		try:
+			f = open(entry, 'rb')
+			try:
+				data = f.read()
+			finally:
+				f.close()
+			os.utime(entry, None)
+		except (IOError, OSError):
+			return None
+		outputs = []
+		pos = 0
+		while pos < len(data):
+			if pos + 4 > len(data):
+				return None
+			n, = struct.unpack_from('<I', data, pos)
+			pos += 4
+			if pos + n > len(data):
+				return None
+			outputs.append(data[pos:pos + n])
+			pos += n
+		return outputs
+
+	def put(self, key, *outputs):
+		"""Store outputs under key and evict old entries if needed."""
+		try:
+			if not path.isdir(self.directory):
+				os.makedirs(self.directory)
+			fd, tmpName = tempfile.mkstemp(dir = self.directory, prefix = '.tmp')
+			try:
+				f = os.fdopen(fd, 'wb')
+				try:
+					for output in outputs:
+						f.write(struct.pack('<I', len(output)))
+						f.write(output)
+				finally:
+					f.close()
+				os.rename(tmpName, path.join(self.directory, key))
+			except:
+				os.unlink(tmpName)
+				raise
+			self.evict()
+		except (IOError, OSError):
+			pass
+
+	def evict(self):
+		"""Remove the least recently used entries until the cache
+		takes no more than maxSize bytes."""
+		entries = []
+		total = 0
+		for name in os.listdir(self.directory):
+			try:
+				st = os.stat(path.join(self.directory, name))
+			except OSError:
+				continue
+			entries.append((st.st_mtime, st.st_size, name))
+			total += st.st_size
+		entries.sort()
+		for mtime, size, name in entries:
+			if total <= self.maxSize:
+				break
+			try:
+				os.unlink(path.join(self.directory, name))
+			except OSError:
+				continue
+			total -= size
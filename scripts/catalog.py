@@ -0,0 +1,200 @@
+#!/usr/bin/python
+
+# catalog - index of bada application folders
+# Copyright (C) 2012 Adrian Matoga
+#
+# bali-sdk is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# bali-sdk is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with bali-sdk.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import json
+import getopt
+import hashlib
+import tempfile
+import xml.parsers.expat
+from os import path
+
+import genhtb
+import buildcache
+
+CATALOG_FILE = os.environ.get('BADA_CATALOG') or path.expanduser('~/.bada-catalog')
+
+def _bytes(obj):
+	"""Turn the unicode strings read from JSON back into byte strings,
+	like the file names returned by os.walk and used in the frames."""
+	if isinstance(obj, unicode):
+		return obj.encode('utf-8')
+	elif isinstance(obj, list):
+		return [_bytes(x) for x in obj]
+	elif isinstance(obj, dict):
+		return dict((_bytes(k), _bytes(v)) for k, v in obj.items())
+	return obj
+
+def isAppDir(dirName):
+	return path.isfile(path.join(dirName, 'Info', 'manifest.xml'))
+
+class Catalog:
+	"""Index of application folders, stored in fileName. For each folder,
+	it keeps the application ID, name, version (also in base36), secret,
+	the total size of the files, the SHA1 digest of the hashtable, and the
+	list of subfolders and files with their sizes, mtimes and digests.
+	Only the files whose size or mtime has changed are read again
+	when the folder is refreshed."""
+
+	def __init__(self, fileName = None):
+		self.fileName = fileName or CATALOG_FILE
+		try:
+			self.apps = _bytes(json.load(open(self.fileName)))
+		except (IOError, ValueError):
+			self.apps = {}
+		self._dirty = False
+
+	def refresh(self, appPath):
+		"""Update the entry of the application folder appPath
+		if anything in it has changed, and return it."""
+		key = path.realpath(appPath)
+		if not path.isdir(key):
+			raise IOError, '%s is not a directory' % appPath
+		old = self.apps.get(key, {})
+		oldFiles = old.get('files', {})
+		dirs = []
+		files = {}
+		for dirname, dirnames, filenames in os.walk(key):
+			rel = path.relpath(dirname, key)
+			prefix = '' if rel == '.' else rel.replace(os.sep, '/') + '/'
+			dirs.extend(prefix + d for d in dirnames)
+			for filename in filenames:
+				fullName = path.join(dirname, filename)
+				st = os.stat(fullName)
+				prev = oldFiles.get(prefix + filename)
+				if prev and prev[0] == st.st_size and prev[1] == st.st_mtime:
+					files[prefix + filename] = prev
+				else:
+					files[prefix + filename] = [st.st_size, st.st_mtime,
+						buildcache.fileDigest(fullName, hashlib.sha1).encode('hex')]
+		dirs.sort()
+		if old and old['dirs'] == dirs and oldFiles == files:
+			return old
+
+		entry = { 'dirs': dirs, 'files': files, 'size': sum(f[0] for f in files.values()) }
+		manifest = files.get('Info/manifest.xml')
+		if manifest and old and oldFiles.get('Info/manifest.xml') == manifest:
+			for k in ('appId', 'secret', 'version', 'base36'):
+				entry[k] = old[k]
+		else:
+			entry.update(appId = None, secret = None, version = None, base36 = None)
+			try:
+				m = genhtb.BadaManifest(path.join(key, 'Info', 'manifest.xml'))
+				entry.update(appId = m.appId, secret = m.secret, version = m.version, base36 = m.getBase36Version())
+			except (IOError, ValueError, xml.parsers.expat.ExpatError):
+				# not a valid bada application, but its files are still listed
+				pass
+		exes = [name for name in files if name.startswith('Bin/') and name.endswith('.exe') and name.count('/') == 1]
+		entry['appName'] = exes[0][len('Bin/'):-len('.exe')] if len(exes) == 1 else None
+		htb = files.get('Info/%s.htb' % entry['appName'])
+		entry['htbDigest'] = htb[2] if htb else None
+		self.apps[key] = entry
+		self._dirty = True
+		return entry
+
+	def scan(self, *roots):
+		"""Refresh the application folders which are or are found
+		in roots, and forget those which are gone. Return the list of tuples
+		(application folder, entry), sorted by folder name."""
+		found = {}
+		for root in roots:
+			root = path.realpath(root)
+			for dirname, dirnames, filenames in os.walk(root):
+				if isAppDir(dirname):
+					found[dirname] = self.refresh(dirname)
+					del dirnames[:]
+			for key in self.apps.keys():
+				if (key == root or key.startswith(root + os.sep)) and not key in found:
+					del self.apps[key]
+					self._dirty = True
+		return sorted(found.items())
+
+	def save(self):
+		"""Write the catalog back to its file if anything has changed."""
+		if not self._dirty:
+			return
+		dirName = path.dirname(path.abspath(self.fileName))
+		fd, tmpName = tempfile.mkstemp(dir = dirName, prefix = '.bada-catalog')
+		try:
+			f = os.fdopen(fd, 'w')
+			try:
+				json.dump(self.apps, f)
+			finally:
+				f.close()
+			os.rename(tmpName, self.fileName)
+		except:
+			os.unlink(tmpName)
+			raise
+		self._dirty = False
+
+def usage():
+	print '''{0} lists the bada applications found in the given folders,
+keeping their details in an index, so that only the files that have changed
+since the last time are read again.
+
+Usage:
+ {0} [-i index_file] [-j] folder...
+ {0} -h|--help
+
+Options:
+ -i,  --index=fn         Specify index file name (default: {1}).
+ -j,  --json             Print everything known about the applications as JSON.'''.format(sys.argv[0], CATALOG_FILE)
+
+def main():
+	try:
+		opts, args = getopt.getopt(sys.argv[1:], "hi:j", ["help", "index=", "json"])
+	except getopt.GetoptError, err:
+		sys.stderr.write('%s: %s\n' % (str(err), sys.argv[0]))
+		sys.stderr.write('invoke %s -h to get usage information\n' % sys.argv[0])
+		sys.exit(2)
+
+	indexFile = None
+	asJson = False
+	for o, a in opts:
+		if o in ('-h', '--help'):
+			usage()
+			sys.exit()
+		elif o in ('-i', '--index'):
+			indexFile = a
+		elif o in ('-j', '--json'):
+			asJson = True
+		else:
+			assert False, 'unhandled option'
+	if not args:
+		sys.stderr.write("%s: no folders to scan\n" % sys.argv[0])
+		sys.exit(2)
+
+	try:
+		catalog = Catalog(indexFile)
+		apps = catalog.scan(*args)
+		catalog.save()
+	except (IOError, OSError, ValueError), err:
+		sys.stderr.write('%s: %s\n' % (sys.argv[0], str(err)))
+		sys.exit(1)
+	if asJson:
+		json.dump(dict(apps), sys.stdout, indent = 1, sort_keys = True)
+		print
+		return
+	print '%-40s %-10s %-12s %-14s %10s  %s' % ('folder', 'id', 'name', 'version', 'size', 'hashtable')
+	for appPath, e in apps:
+		print '%-40s %-10s %-12s %-14s %10d  %s' % (appPath, e['appId'], e['appName'],
+			'%s (%s)' % (e['version'], e['base36']) if e['version'] else None, e['size'], e['htbDigest'])
+
+if __name__ == "__main__":
+	main()
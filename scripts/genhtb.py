@@ -17,18 +17,60 @@
 # along with bali-sdk.  If not, see <http://www.gnu.org/licenses/>.
 
 import sys
+import os
 import hashlib
 import struct
 import re
-import xml.dom.minidom
+import mmap
+import getopt
+import multiprocessing
+import xml.parsers.expat
+
+import buildcache
+
+class _ManifestParsed(Exception):
+	pass
 
 class BadaManifest:
-	"""Class for parsing bada manifest files"""
+	"""Class for parsing bada manifest files, given as a file name
+	or a file object. Only the text of the first Id, Secret and AppVersion
+	elements is read, and parsing stops as soon as all of them are found."""
+
+	_FIELDS = { 'Id': 'appId', 'Secret': 'secret', 'AppVersion': 'version' }
+
 	def __init__(self, manifestFile):
-		self.dom = xml.dom.minidom.parse(manifestFile)
-		self.appId = self.dom.getElementsByTagName("Id")[0].childNodes[0].data
-		self.secret = self.dom.getElementsByTagName("Secret")[0].childNodes[0].data
-		self.version = self.dom.getElementsByTagName("AppVersion")[0].childNodes[0].data
+		values = {}
+		current = []
+		def endText(*args):
+			if current:
+				name, text = current.pop()
+				if text:
+					values[name] = ''.join(text)
+					if len(values) == len(self._FIELDS):
+						raise _ManifestParsed
+		def start(name, attrs):
+			endText()
+			if name in self._FIELDS and not name in values:
+				current.append((name, []))
+		def characters(data):
+			if current:
+				current[0][1].append(data)
+		parser = xml.parsers.expat.ParserCreate()
+		parser.StartElementHandler = start
+		parser.EndElementHandler = endText
+		parser.CharacterDataHandler = characters
+		f = open(manifestFile, 'rb') if isinstance(manifestFile, basestring) else manifestFile
+		try:
+			parser.ParseFile(f)
+		except _ManifestParsed:
+			pass
+		finally:
+			if f is not manifestFile:
+				f.close()
+		for name, attr in self._FIELDS.items():
+			if not name in values:
+				raise ValueError, 'no %s in the manifest' % name
+			setattr(self, attr, values[name])
 
 	_dig = '0123456789abcdefghijklmnopqrstuvwxyz'
 
@@ -40,40 +82,132 @@ class BadaManifest:
 		buildh, buildl = divmod(int(mo.group(3)), 36)
 		return self._dig[int(mo.group(1))] + self._dig[int(mo.group(2))] + self._dig[buildh] + self._dig[buildl]
 
-def readByChunk(fileObject, chunkSize):
-	while True:
-		data = fileObject.read(chunkSize)
-		if not data:
-			break
-		yield data
-
-def writeString(fileObject, s):
-	fileObject.write(struct.pack("<I", len(s)))
-	fileObject.write(s)
-
-if len(sys.argv) != 2 and len(sys.argv) != 4:
-	print "Usage:\n", sys.argv[0], "manifest_file [exe_file htb_file]"
-	exit(1)
-
-manifest = BadaManifest(sys.argv[1])
-version = manifest.getBase36Version()
-headerLength = len("Hash") + 4 + 4 + 4 + len(manifest.appId) + 4 + len(version) + 4 + len(manifest.secret)
-
-print "id:     ", manifest.appId
-print "secret: ", manifest.secret
-print "version:", manifest.version, '(%s)' % version
-
-if len(sys.argv) == 4:
-	inf = open(sys.argv[2])
-	outf = open(sys.argv[3], 'w')
-
-	outf.write("Hash")
-	outf.write(struct.pack("<II", 1, headerLength))
-	writeString(outf, manifest.appId)
-	writeString(outf, version)
-	writeString(outf, manifest.secret)
-
-	for piece in readByChunk(inf, 4096):
-		s = hashlib.sha1()
-		s.update(piece)
-		outf.write(s.digest())
+def htbHeader(manifest):
+	"""Return the header of the hashtable file for the application
+	described by manifest (a BadaManifest)."""
+	version = manifest.getBase36Version()
+	headerLength = len("Hash") + 4 + 4 + 4 + len(manifest.appId) + 4 + len(version) + 4 + len(manifest.secret)
+	return "Hash" + struct.pack("<II", 1, headerLength) + \
+		packString(manifest.appId) + packString(version) + packString(manifest.secret)
+
+def parseHtbHeader(htb):
+	"""Return tuple (appId, version, secret, headerLength) read from
+	the header of the hashtable htb. The page digests follow the header."""
+	if htb[:4] != "Hash" or len(htb) < 12:
+		raise ValueError, 'not a hashtable file'
+	fmt, headerLength = struct.unpack_from("<II", htb, 4)
+	if fmt != 1:
+		raise ValueError, 'unsupported hashtable format %d' % fmt
+	strings = []
+	pos = 12
+	for i in range(3):
+		if pos + 4 > headerLength:
+			raise ValueError, 'truncated hashtable header'
+		n, = struct.unpack_from("<I", htb, pos)
+		strings.append(htb[pos + 4:pos + 4 + n])
+		pos += 4 + n
+	if pos != headerLength or headerLength > len(htb):
+		raise ValueError, 'invalid hashtable header length'
+	return tuple(strings) + (headerLength,)
+
+def packString(s):
+	# the manifest strings are unicode, which used to be written
+	# to the file with the default (ascii) encoding
+	s = str(s)
+	return struct.pack("<I", len(s)) + s
+
+PAGE_SIZE = 4096
+
+# executables smaller than this are hashed in a single process,
+# as starting the workers would take longer than hashing
+PARALLEL_THRESHOLD = 8 << 20
+
+def hashPages(data, start, end):
+	"""Return the concatenated SHA1 digests of the pages of data
+	between offsets start and end."""
+	sha1 = hashlib.sha1
+	return ''.join(sha1(buffer(data, i, min(PAGE_SIZE, end - i))).digest() for i in xrange(start, end, PAGE_SIZE))
+
+def _hashFilePages(args):
+	fileName, start, end = args
+	f = open(fileName, 'rb')
+	try:
+		m = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+		try:
+			return hashPages(m, start, end)
+		finally:
+			m.close()
+	finally:
+		f.close()
+
+def pageDigests(exeFileName, processes = None):
+	"""Return the table of SHA1 digests of the 4 KiB pages of the
+	executable. Large executables are hashed by processes workers
+	(by default, one per core)."""
+	size = os.path.getsize(exeFileName)
+	if size == 0:
+		return ''
+	if processes is None:
+		processes = multiprocessing.cpu_count()
+	if processes > 1 and size >= PARALLEL_THRESHOLD:
+		npages = (size + PAGE_SIZE - 1) // PAGE_SIZE
+		step = (npages + processes * 4 - 1) // (processes * 4) * PAGE_SIZE
+		pool = multiprocessing.Pool(processes)
+		try:
+			return ''.join(pool.map(_hashFilePages,
+				[(exeFileName, i, min(i + step, size)) for i in xrange(0, size, step)]))
+		finally:
+			pool.close()
+			pool.join()
+	return _hashFilePages((exeFileName, 0, size))
+
+def generate_htb(manifest, exe, out, processes = None):
+	"""Generate the hashtable file for the executable exe of the
+	application described by manifest, which is either the name of the
+	manifest file or a BadaManifest, and write it to out, either a file
+	name or a file object. Return the contents of the hashtable file."""
+	if not isinstance(manifest, BadaManifest):
+		manifest = BadaManifest(manifest)
+	htb = htbHeader(manifest) + pageDigests(exe, processes)
+	if hasattr(out, 'write'):
+		out.write(htb)
+	else:
+		outf = open(out, 'wb')
+		try:
+			outf.write(htb)
+		finally:
+			outf.close()
+	return htb
+
+def main():
+	try:
+		opts, args = getopt.getopt(sys.argv[1:], "", ["no-cache"])
+	except getopt.GetoptError, err:
+		opts, args = [], []
+	if len(args) != 1 and len(args) != 3:
+		print "Usage:\n", sys.argv[0], "[--no-cache] manifest_file [exe_file htb_file]"
+		exit(1)
+	useCache = ('--no-cache', '') not in opts
+
+	manifest = BadaManifest(args[0])
+	version = manifest.getBase36Version()
+
+	print "id:     ", manifest.appId
+	print "secret: ", manifest.secret
+	print "version:", manifest.version, '(%s)' % version
+
+	if len(args) == 3:
+		manifestFile, exe, out = args
+		if useCache:
+			cache = buildcache.BuildCache()
+			key = cache.key('htb', [manifestFile, exe])
+			outputs = cache.get(key)
+			if outputs:
+				file(out, 'wb').write(outputs[0])
+				return
+		htb = generate_htb(manifest, exe, out)
+		if useCache:
+			cache.put(key, htb)
+
+if __name__ == "__main__":
+	main()
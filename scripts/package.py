@@ -0,0 +1,190 @@
+#!/usr/bin/python
+
+# package - program to generate the hashtable and signature files
+# of bada apps in a single pass
+# Copyright (C) 2012 Adrian Matoga
+#
+# bali-sdk is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# bali-sdk is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with bali-sdk.  If not, see <http://www.gnu.org/licenses/>.
+
+# Warning: Requires pyOpenSSL 0.13
+
+import sys
+import hashlib
+import getopt
+import StringIO
+from os import path
+
+import genhtb
+import buildcache
+import signing
+
+def buildPackage(appPath, appName, signer, devcert, cacert):
+	"""Generate the hashtable file and signature.xml for the application
+	in appPath, reading the manifest and the executable only once.
+	The executable is read in chunks, each of which is hashed page
+	by page for the hashtable and fed to the package signature digest.
+	Return tuple (hashtable, signature.xml contents), identical to what
+	bada-genhtb and bada-signing produce."""
+	appFile = path.join(appPath, 'Bin', appName + '.exe')
+	manifestFile = path.join(appPath, 'Info', 'manifest.xml')
+
+	manifestData = open(manifestFile, 'rb').read()
+	manifest = genhtb.BadaManifest(StringIO.StringIO(manifestData))
+
+	digests = []
+	h = hashlib.sha1()
+	# a whole number of pages
+	buf = bytearray(256 * genhtb.PAGE_SIZE)
+	for chunk in buildcache.readChunks(appFile, buf):
+		digests.append(genhtb.hashPages(buf, 0, len(chunk)))
+		h.update(chunk)
+	h.update(manifestData)
+	packageSignature = signer.signDigest(h.digest())
+	htb = genhtb.htbHeader(manifest) + ''.join(digests)
+	appSignature = signer.sign(htb)
+	return htb, signing.signatureXml(appName, devcert, cacert, packageSignature, appSignature)
+
+def usage():
+	print '''{0} generates the hashtable and signature files for bada applications,
+the same as bada-genhtb and bada-signing would, but reading the executable
+and the manifest only once.
+
+Example:
+ {0} -p /opt/badasdk/crypto -a 93bt1p123e -n App
+
+Usage:
+ {0} [-p path] [-k dev_key] [-d dev_cert] [-c ca_cert] [-w passphrase] \\
+     -a app_path -n app_name [-t htb_file] [-o output_file]
+ {0} -h|--help
+
+{0} reads the following files from the application folder,
+specified with the -a option:
+ - {{app_path}}/Bin/{{app_name}}.exe  - the application executable file
+ - {{app_path}}/Info/manifest.xml   - the manifest file
+and writes:
+ - {{app_path}}/Info/{{app_name}}.htb - the hashtable file
+ - {{app_path}}/signature.xml       - the signature file
+
+Options:
+ -o,  --output=fn        Specify signature file name.
+ -t,  --htb-file=fn      Specify hashtable file name.
+ -a,  --app-path=fn      Specify path to the application folder.
+                         In most cases, its last part is the application ID.
+ -n,  --app-name=name    Specify application name. This will be used to
+                         find executable and hashtable files in the
+                         application folder.
+ -p,  --crypto-path=path Specify path where {0} will search for
+                         default key end certificate file names.
+ -k,  --devkey-file=fn   Specify bada development private key file name.
+ -d,  --devcert-file=fn  Specify bada development certificate file name.
+ -c,  --cacert-file=fn   Specify bada development CA certificate file name.
+ -w,  --passphrase=pass  Specify passphrase for the private key.
+                         '1111' is used if this option is omitted.
+      --no-cache         Always generate the files, even if they have
+                         already been generated from the same files.'''.format(sys.argv[0])
+
+def main():
+	try:
+		opts, args = getopt.getopt(
+			sys.argv[1:],
+			"ho:t:a:n:p:k:d:c:w:",
+			["help", "output=", "htb-file=", "app-path=", "app-name=", "crypto-path=", "devkey-file=", "devcert-file=", "cacert-file=", "passphrase=",
+			"no-cache"])
+	except getopt.GetoptError, err:
+		sys.stderr.write('%s: %s\n' % (str(err), sys.argv[0]))
+		sys.stderr.write('invoke %s -h to get usage information\n' % sys.argv[0])
+		sys.exit(2)
+
+	outputFile = None
+	htbFile = None
+	appPath = None
+	appName = None
+	cryptoPath = None
+	devKeyFile = None
+	devCertFile = None
+	caCertFile = None
+	passphrase = '1111'
+	useCache = True
+	for o, a in opts:
+		if o in ('-h', '--help'):
+			usage()
+			sys.exit()
+		elif o in ('-o', '--output'):
+			outputFile = a
+		elif o in ('-t', '--htb-file'):
+			htbFile = a
+		elif o in ('-a', '--app-path'):
+			appPath = a
+		elif o in ('-n', '--app-name'):
+			appName = a
+		elif o in ('-p', '--crypto-path'):
+			cryptoPath = a
+		elif o in ('-k', '--devkey-file'):
+			devKeyFile = a
+		elif o in ('-d', '--devcert-file'):
+			devCertFile = a
+		elif o in ('-c', '--cacert-file'):
+			caCertFile = a
+		elif o in ('-w', '--passphrase'):
+			passphrase = a
+		elif o == '--no-cache':
+			useCache = False
+		else:
+			assert False, 'unhandled option'
+	if not cryptoPath is None:
+		if not devKeyFile:
+			devKeyFile = path.join(cryptoPath, 'badaDevPriKey.pem')
+		if not devCertFile:
+			devCertFile = path.join(cryptoPath, 'badaDev.cer')
+		if not caCertFile:
+			caCertFile = path.join(cryptoPath, 'badaCA.cer')
+	for f, t in [
+		(appPath, "Application path"),
+		(appName, "Application name"),
+		(devKeyFile, "Private key file"),
+		(devCertFile, "Development certificate file"),
+		(caCertFile, "CA certificate file")]:
+		if f is None:
+			sys.stderr.write("%s: %s not specified\n" % (sys.argv[0], t))
+			sys.exit(2)
+	if htbFile is None:
+		htbFile = path.join(appPath, 'Info', appName + '.htb')
+	if outputFile is None:
+		outputFile = path.join(appPath, 'signature.xml')
+
+	try:
+		if useCache:
+			cache = buildcache.BuildCache()
+			key = cache.key('package', [
+				path.join(appPath, 'Bin', appName + '.exe'),
+				path.join(appPath, 'Info', 'manifest.xml'),
+				devKeyFile, devCertFile, caCertFile], appName, passphrase)
+			outputs = cache.get(key)
+		if useCache and outputs:
+			htb, signature = outputs
+		else:
+			signer = signing.Signer(devKeyFile, passphrase)
+			devcert = signing.stripCertificate(devCertFile)
+			cacert = signing.stripCertificate(caCertFile)
+			htb, signature = buildPackage(appPath, appName, signer, devcert, cacert)
+			if useCache:
+				cache.put(key, htb, signature)
+		file(htbFile, 'wb').write(htb)
+		file(outputFile, 'w').write(signature)
+	except IOError, err:
+		sys.stderr.write('%s: %s\n' % (sys.argv[0], str(err)))
+		sys.exit(1)
+
+if __name__ == "__main__":
+	main()
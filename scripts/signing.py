@@ -16,25 +16,168 @@
 # You should have received a copy of the GNU General Public License
 # along with bali-sdk.  If not, see <http://www.gnu.org/licenses/>.
 
-# Warning: Requires pyOpenSSL 0.13
+# Warning: Requires pyOpenSSL 0.13. With pyOpenSSL 16 or newer, signatures
+# are made and checked by the cryptography package it depends on.
 
 import sys
 import base64
 import re
 import getopt
+import hashlib
+import time
+import glob
+import multiprocessing
 from os import path
-from OpenSSL import crypto
+
+import buildcache
+
+def derItems(data):
+	"""Split DER-encoded data into a list of tuples (tag, contents).
+	Raise ValueError if the data is truncated."""
+	items = []
+	pos = 0
+	while pos < len(data):
+		if pos + 2 > len(data):
+			raise ValueError, 'truncated DER header'
+		tag = ord(data[pos])
+		n = ord(data[pos + 1])
+		pos += 2
+		if n & 0x80:
+			k = n & 0x7f
+			if k == 0 or pos + k > len(data):
+				raise ValueError, 'invalid DER length'
+			n = int(data[pos:pos + k].encode('hex'), 16)
+			pos += k
+		if pos + n > len(data):
+			raise ValueError, 'truncated DER contents'
+		items.append((tag, data[pos:pos + n]))
+		pos += n
+	return items
+
+def rsaNumbers(der):
+	"""Return tuple (n, e, d, p, q, dp, dq, qinv) from a DER-encoded RSA
+	private key, either bare (PKCS#1) or wrapped in PKCS#8."""
+	items = derItems(der)
+	fields = derItems(items[0][1]) if items else []
+	if len(fields) >= 3 and fields[1][0] == 0x30:
+		# AlgorithmIdentifier, followed by the PKCS#1 key in an OCTET STRING
+		return rsaNumbers(fields[2][1])
+	if len(fields) < 9:
+		raise ValueError, 'not an RSA private key'
+	return tuple(int(c.encode('hex') or '0', 16) for tag, c in fields[1:9])
+
+# DER encoding of the rsaEncryption OID
+_RSA_OID = '06092a864886f70d010101'.decode('hex')
+
+def certificateKey(cert):
+	"""Return tuple (n, e) of the RSA public key in the base64-encoded
+	certificate, as returned by stripCertificate."""
+	tbs = derItems(derItems(derItems(base64.b64decode(cert))[0][1])[0][1])
+	for tag, contents in tbs:
+		if tag == 0x30 and contents.startswith('\x30\x0d' + _RSA_OID):
+			# skip the AlgorithmIdentifier and the unused bits of the BIT STRING
+			key = derItems(derItems(contents)[1][1][1:])[0][1]
+			return tuple(int(c.encode('hex'), 16) for tag, c in derItems(key)[:2])
+	raise TypeError, 'No RSA public key in the certificate'
+
+def verifySignature(key, digest, signature):
+	"""Check if the base64-encoded signature is the RSASSA-PKCS1-v1_5
+	signature of the data whose SHA1 digest is given, made with the
+	private key matching key, a tuple (n, e)."""
+	n, e = key
+	try:
+		signature = base64.b64decode(signature)
+	except TypeError:
+		return False
+	try:
+		from cryptography.exceptions import InvalidSignature
+		from cryptography.hazmat.backends import default_backend
+		from cryptography.hazmat.primitives import hashes
+		from cryptography.hazmat.primitives.asymmetric import padding, rsa, utils
+	except ImportError:
+		pass
+	else:
+		public = rsa.RSAPublicNumbers(e, n).public_key(default_backend())
+		try:
+			public.verify(signature, digest, padding.PKCS1v15(), utils.Prehashed(hashes.SHA1()))
+			return True
+		except InvalidSignature:
+			return False
+	# only for old pyOpenSSL, which comes without cryptography
+	k = (n.bit_length() + 7) // 8
+	s = int(signature.encode('hex') or '0', 16)
+	if s >= n:
+		return False
+	t = Signer._SHA1_PREFIX + digest
+	if k < len(t) + 11:
+		return False
+	return pow(s, e, n) == int(('\x00\x01' + '\xff' * (k - len(t) - 3) + '\x00' + t).encode('hex'), 16)
 
 class Signer:
+	"""Signs data with the SHA1 digest and RSA key, the same way OpenSSL's
+	EVP_Sign* functions do (RSASSA-PKCS1-v1_5). The digest is computed
+	incrementally, so the data does not have to be in memory at once."""
+
+	# DER encoding of the DigestInfo for SHA1, without the digest
+	_SHA1_PREFIX = '3021300906052b0e03021a05000414'.decode('hex')
+
 	def __init__(self, keyfile, passphrase):
+		# imported here, as it takes longer than restoring a cached signature
+		from OpenSSL import crypto
 		self._key = crypto.load_privatekey(crypto.FILETYPE_PEM, file(keyfile).read(), passphrase)
+		if self._key.type() != crypto.TYPE_RSA:
+			raise TypeError, 'Only RSA keys are supported'
+		if hasattr(self._key, 'to_cryptography_key'):
+			self._cryptographyKey = self._key.to_cryptography_key()
+		else:
+			self._cryptographyKey = None
+			self._rsa = rsaNumbers(crypto.dump_privatekey(crypto.FILETYPE_ASN1, self._key))
+
+	def signDigest(self, digest):
+		"""Return the base64-encoded signature of the data whose SHA1
+		digest is given."""
+		if self._cryptographyKey:
+			from cryptography.hazmat.primitives import hashes
+			from cryptography.hazmat.primitives.asymmetric import padding, utils
+			return base64.b64encode(self._cryptographyKey.sign(
+				digest, padding.PKCS1v15(), utils.Prehashed(hashes.SHA1())))
+		# pyOpenSSL older than 16 cannot hand the key over to cryptography,
+		# and only signs whole strings, so the signature is computed here
+		n, e, d, p, q, dp, dq, qinv = self._rsa
+		k = (n.bit_length() + 7) // 8
+		t = self._SHA1_PREFIX + digest
+		m = int(('\x00\x01' + '\xff' * (k - len(t) - 3) + '\x00' + t).encode('hex'), 16)
+		s1 = pow(m % p, dp, p)
+		s2 = pow(m % q, dq, q)
+		sig = s2 + (qinv * (s1 - s2)) % p * q
+		# a fault in either half would give away p and q with the signature,
+		# so it is never returned unchecked
+		if pow(sig, e, n) != m:
+			sig = pow(m, d, n)
+			if pow(sig, e, n) != m:
+				raise ValueError, 'RSA signature check failed'
+		return base64.b64encode(('%0*x' % (2 * k, sig)).decode('hex'))
+
+	def sign(self, *parts):
+		"""Return the base64-encoded SHA1 signature of the concatenated
+		parts, which may be strings, mmaps or other buffers."""
+		h = hashlib.sha1()
+		for p in parts:
+			h.update(p)
+		return self.signDigest(h.digest())
 
 	def signFiles(self, *filelist):
-		data = ''.join(file(f).read() for f in filelist)
-		signature = crypto.sign(self._key, data, 'sha1')
-		return base64.b64encode(signature)
+		"""Return the base64-encoded SHA1 signature of the concatenated
+		contents of the files, read in chunks into a single buffer."""
+		h = hashlib.sha1()
+		buf = bytearray(buildcache.CHUNK_SIZE)
+		for fileName in filelist:
+			for chunk in buildcache.readChunks(fileName, buf):
+				h.update(chunk)
+		return self.signDigest(h.digest())
 
 def stripCertificate(certfile):
+	from OpenSSL import crypto
 	cert = crypto.load_certificate(crypto.FILETYPE_PEM, file(certfile).read())
 	mo = re.match(
 		# only rough check for sth that looks more or less like base64 encoded string
@@ -45,6 +188,99 @@ def stripCertificate(certfile):
 	else:
 		raise TypeError, 'Invalid certificate dump syntax'
 
+def signatureXml(appName, devcert, cacert, packageSignature, appSignature):
+	"""Return the contents of signature.xml with the given certificates
+	and signatures of the package (executable and manifest) and the
+	application (hashtable)."""
+	return '''<?xml version="1.0"?>
+<Signature>
+  <FileList>
+    <File>{0}</File>
+    <File>{1}</File>
+  </FileList>
+  <certificateChain>
+    <certificate>
+{2}
+    </certificate>
+    <certificate>
+{3}
+    </certificate>
+  </certificateChain>
+  <SignValue>
+    <Package>
+{4}
+    </Package>
+    <AppSignature>
+{5}
+    </AppSignature>
+  </SignValue>
+</Signature>
+'''.format(
+		'/Bin/' + appName + '.exe', '/Info/manifest.xml',
+		devcert, cacert, packageSignature, appSignature)
+
+def signApp(signer, devcert, cacert, appPath, appName):
+	"""Return the contents of signature.xml for the application in appPath."""
+	appFile = path.join(appPath, 'Bin', appName + '.exe')
+	htbFile = path.join(appPath, 'Info', appName + '.htb')
+	manifestFile = path.join(appPath, 'Info', 'manifest.xml')
+	packageSignature = signer.signFiles(appFile, manifestFile)
+	appSignature = signer.signFiles(htbFile)
+	return signatureXml(appName, devcert, cacert, packageSignature, appSignature)
+
+def guessAppName(appPath):
+	"""Return the name of the only executable in the application folder."""
+	exes = glob.glob(path.join(appPath, 'Bin', '*.exe'))
+	if len(exes) != 1:
+		raise ValueError, 'cannot tell the application name in %s' % appPath
+	return path.basename(exes[0])[:-len('.exe')]
+
+def readJobFile(fileName):
+	"""Read the list of applications to sign in a batch. Each line of
+	the file reads: app_path [app_name [output_file]]. Empty lines and
+	anything after # are ignored. Return a list of tuples
+	(app_path, app_name, output_file), with None for what is not given."""
+	jobs = []
+	for line in file(fileName):
+		fields = line.split('#', 1)[0].split()
+		if fields:
+			jobs.append(tuple(fields[:3]) + (None,) * (3 - len(fields[:3])))
+	return jobs
+
+# the signer and certificates used by signBatch, inherited by its workers
+_batch = None
+
+def _signJob(job):
+	appPath, appName, outputFile = job
+	start = time.time()
+	try:
+		signer, devcert, cacert = _batch
+		signature = signApp(signer, devcert, cacert, appPath, appName or guessAppName(appPath))
+		file(outputFile or path.join(appPath, 'signature.xml'), 'w').write(signature)
+		return appPath, time.time() - start, None
+	except Exception, err:
+		return appPath, time.time() - start, str(err) or err.__class__.__name__
+
+def signBatch(signer, devcert, cacert, jobs, processes = None):
+	"""Sign the applications given as tuples (app_path, app_name, output_file),
+	where app_name and output_file may be None, using processes workers
+	(by default, one per core), which share the key and certificates loaded
+	once. Yield tuple (app_path, seconds, error message or None) for each
+	application, in the order of jobs, as soon as it is done."""
+	global _batch
+	_batch = (signer, devcert, cacert)
+	if processes == 1 or len(jobs) < 2:
+		for job in jobs:
+			yield _signJob(job)
+		return
+	pool = multiprocessing.Pool(processes)
+	try:
+		for res in pool.imap(_signJob, jobs):
+			yield res
+	finally:
+		pool.close()
+		pool.join()
+
 def usage():
 	print '''{0} generates signature files for bada applications.
 
@@ -54,6 +290,8 @@ Example:
 Usage:
  {0} [-p path] [-k dev_key] [-d dev_cert] [-c ca_cert] \\
      -a app_path -n app_name [-o output_file]
+ {0} [-p path] [-k dev_key] [-d dev_cert] [-c ca_cert] \\
+     -b [-j n] [-f job_file] [app_path[:app_name]...]
  {0} -h|--help
 
 {0} expects the following files to be present in the application folder,
@@ -75,15 +313,62 @@ Options:
  -k,  --devkey-file=fn   Specify bada development private key file name.
  -d,  --devcert-file=fn  Specify bada development certificate file name.
  -c,  --cacert-file=fn   Specify bada development CA certificate file name.
- -a,  --passphrase=pass  Specify passphrase for the private key.
-                         '1111' is used if this option is omitted.'''.format(sys.argv[0])
+ -w,  --passphrase=pass  Specify passphrase for the private key.
+                         '1111' is used if this option is omitted.
+ -b,  --batch            Sign all applications given as arguments or
+                         in the job file, each to {{app_path}}/signature.xml.
+                         If app_name is not given, it is taken from the
+                         only executable in {{app_path}}/Bin.
+ -f,  --job-file=fn      Read the applications to sign from fn, one per
+                         line: app_path [app_name [output_file]].
+ -j,  --jobs=n           Sign up to n applications at the same time
+                         (default: number of cores).
+      --no-cache         Always sign, even if the same files have
+                         already been signed before.'''.format(sys.argv[0])
+
+def batchMain(args, jobFile, processes, devKeyFile, devCertFile, caCertFile, passphrase):
+	for f, t in [
+		(devKeyFile, "Private key file"),
+		(devCertFile, "Development certificate file"),
+		(caCertFile, "CA certificate file")]:
+		if f is None:
+			sys.stderr.write("%s: %s not specified\n" % (sys.argv[0], t))
+			sys.exit(2)
+	jobs = []
+	for a in args:
+		appPath, sep, appName = a.partition(':')
+		jobs.append((appPath, appName or None, None))
+	try:
+		if jobFile:
+			jobs += readJobFile(jobFile)
+		if not jobs:
+			sys.stderr.write("%s: no applications to sign\n" % sys.argv[0])
+			sys.exit(2)
+		signer = Signer(devKeyFile, passphrase)
+		devcert = stripCertificate(devCertFile)
+		cacert = stripCertificate(caCertFile)
+	except IOError, err:
+		sys.stderr.write('%s: %s\n' % (sys.argv[0], str(err)))
+		sys.exit(1)
+
+	start = time.time()
+	failed = 0
+	print '%-40s %8s  %s' % ('application', 'seconds', 'status')
+	for appPath, t, err in signBatch(signer, devcert, cacert, jobs, processes):
+		if err:
+			failed += 1
+		print '%-40s %8.3f  %s' % (appPath, t, 'error: ' + err if err else 'signed')
+		sys.stdout.flush()
+	print '%d signed, %d failed in %.2f s' % (len(jobs) - failed, failed, time.time() - start)
+	sys.exit(1 if failed else 0)
 
 def main():
 	try:	
 		opts, args = getopt.getopt(
 			sys.argv[1:],
-			"ho:a:n:m:p:k:d:c:w:",
-			["help", "output=", "app-path=", "app-name=", "crypto-path=", "devkey-file=", "devcert-file=", "cacert-file=", "passphrase="])
+			"ho:a:n:m:p:k:d:c:w:bf:j:",
+			["help", "output=", "app-path=", "app-name=", "crypto-path=", "devkey-file=", "devcert-file=", "cacert-file=", "passphrase=",
+			"batch", "job-file=", "jobs=", "no-cache"])
 	except getopt.GetoptError, err:
 		# print help information and exit
 		sys.stderr.write('%s: %s\n' % (str(err), sys.argv[0]))
@@ -98,6 +383,10 @@ def main():
 	devCertFile = None
 	caCertFile = None
 	passphrase = '1111'
+	batch = False
+	jobFile = None
+	processes = None
+	useCache = True
 	for o, a in opts:
 		if o in ('-h', '--help'):
 			usage()
@@ -118,6 +407,14 @@ def main():
 			caCertFile = a
 		elif o in ('-w', '--passphrase'):
 			passphrase = a
+		elif o in ('-b', '--batch'):
+			batch = True
+		elif o in ('-f', '--job-file'):
+			jobFile = a
+		elif o in ('-j', '--jobs'):
+			processes = max(1, int(a))
+		elif o == '--no-cache':
+			useCache = False
 		else:
 			assert False, 'unhandled option'
 	if not cryptoPath is None:
@@ -127,6 +424,8 @@ def main():
 			devCertFile = path.join(cryptoPath, 'badaDev.cer')
 		if not caCertFile:
 			caCertFile = path.join(cryptoPath, 'badaCA.cer')
+	if batch:
+		batchMain(args, jobFile, processes, devKeyFile, devCertFile, caCertFile, passphrase)
 	for f, t in [
 		(appPath, "Application path"),
 		(appName, "Application name"),
@@ -137,43 +436,24 @@ def main():
 			sys.stderr.write("%s: %s not specified\n" % (sys.argv[0], t))
 			sys.exit(2)
 
-	appFile = path.join(appPath, 'Bin', appName + '.exe')
-	htbFile = path.join(appPath, 'Info', appName + '.htb')
-	manifestFile = path.join(appPath, 'Info', 'manifest.xml')
-
 	try:
-		signer = Signer(devKeyFile, '1111')
-		packageSignature = signer.signFiles(appFile, manifestFile)
-		appSignature = signer.signFiles(htbFile)
-		devcert = stripCertificate(devCertFile)
-		cacert = stripCertificate(caCertFile)
-
-		signature = '''<?xml version="1.0"?>
-<Signature>
-  <FileList>
-    <File>{0}</File>
-    <File>{1}</File>
-  </FileList>
-  <certificateChain>
-    <certificate>
-{2}
-    </certificate>
-    <certificate>
-{3}
-    </certificate>
-  </certificateChain>
-  <SignValue>
-    <Package>
-{4}
-    </Package>
-    <AppSignature>
-{5}
-    </AppSignature>
-  </SignValue>
-</Signature>
-'''.format(
-		'/Bin/' + appName + '.exe', '/Info/manifest.xml',
-		devcert, cacert, packageSignature, appSignature)
+		if useCache:
+			cache = buildcache.BuildCache()
+			key = cache.key('signature', [
+				path.join(appPath, 'Bin', appName + '.exe'),
+				path.join(appPath, 'Info', appName + '.htb'),
+				path.join(appPath, 'Info', 'manifest.xml'),
+				devKeyFile, devCertFile, caCertFile], appName, passphrase)
+			outputs = cache.get(key)
+		if useCache and outputs:
+			signature = outputs[0]
+		else:
+			signer = Signer(devKeyFile, passphrase)
+			devcert = stripCertificate(devCertFile)
+			cacert = stripCertificate(caCertFile)
+			signature = signApp(signer, devcert, cacert, appPath, appName)
+			if useCache:
+				cache.put(key, signature)
 
 		output = sys.stdout if not outputFile else file(outputFile, 'w')
 		output.write(signature)
@@ -0,0 +1,269 @@
+#!/usr/bin/python
+
+# verify - program to check the hashtable and signature files
+# of bada apps before they are installed
+# Copyright (C) 2012 Adrian Matoga
+#
+# bali-sdk is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# bali-sdk is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with bali-sdk.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import re
+import sys
+import mmap
+import time
+import getopt
+import StringIO
+import hashlib
+import multiprocessing
+from os import path
+
+import genhtb
+import signing
+
+# number of pages whose digests are compared at once
+BATCH_PAGES = 256
+
+_DIGEST_SIZE = 20
+
+def _element(data, tag):
+	return re.findall('<%s>\s*(.*?)\s*</%s>' % (tag, tag), data, re.S)
+
+def readSignatureXml(data):
+	"""Return tuple (file list, certificates, package signature,
+	application signature) read from the contents of signature.xml."""
+	signatures = [_element(data, tag) for tag in ('Package', 'AppSignature')]
+	if [len(s) for s in signatures] != [1, 1]:
+		raise ValueError, 'no signatures in signature.xml'
+	return (_element(data, 'File'), [re.sub('\s', '', c) for c in _element(data, 'certificate')],
+		re.sub('\s', '', signatures[0][0]), re.sub('\s', '', signatures[1][0]))
+
+def _checkPages(exe, digests, problems):
+	"""Compare the digests of the pages of the open file exe with the
+	page digests from the hashtable, a batch of pages at a time,
+	unless digests is None. Return the SHA1 hash object fed with the whole file."""
+	h = hashlib.sha1()
+	size = os.fstat(exe.fileno()).st_size
+	npages = (size + genhtb.PAGE_SIZE - 1) // genhtb.PAGE_SIZE
+	if digests is not None and len(digests) != npages * _DIGEST_SIZE:
+		problems.append('hashtable has %d page digests, executable has %d pages' % (
+			len(digests) // _DIGEST_SIZE, npages))
+	if size == 0:
+		return h
+	m = mmap.mmap(exe.fileno(), 0, access = mmap.ACCESS_READ)
+	try:
+		bad = []
+		step = BATCH_PAGES * genhtb.PAGE_SIZE
+		for start in xrange(0, size, step):
+			end = min(start + step, size)
+			h.update(buffer(m, start, end - start))
+			if digests is None:
+				continue
+			first = start // genhtb.PAGE_SIZE * _DIGEST_SIZE
+			actual = genhtb.hashPages(m, start, end)
+			expected = digests[first:first + len(actual)]
+			if actual != expected:
+				bad.extend(first // _DIGEST_SIZE + i // _DIGEST_SIZE
+					for i in xrange(0, len(actual), _DIGEST_SIZE)
+					if actual[i:i + _DIGEST_SIZE] != expected[i:i + _DIGEST_SIZE])
+		if bad:
+			problems.append('%d page digests do not match, the first one of page %d' % (len(bad), bad[0]))
+	finally:
+		m.close()
+	return h
+
+def verifyPackage(appPath, appName = None, devcert = None, cacert = None):
+	"""Check the hashtable and signature.xml of the application in appPath
+	against its executable and manifest, and the signatures against
+	devcert (base64-encoded, as returned by signing.stripCertificate),
+	or the first certificate in signature.xml if devcert is None.
+	If given, cacert must be the second certificate in signature.xml.
+	Return the list of problems found, which is empty if there are none."""
+	if appName is None:
+		appName = signing.guessAppName(appPath)
+	problems = []
+	manifestData = file(path.join(appPath, 'Info', 'manifest.xml'), 'rb').read()
+	htb = file(path.join(appPath, 'Info', appName + '.htb'), 'rb').read()
+	files, certificates, packageSignature, appSignature = readSignatureXml(
+		file(path.join(appPath, 'signature.xml'), 'rb').read())
+
+	manifest = genhtb.BadaManifest(StringIO.StringIO(manifestData))
+	try:
+		appId, version, secret, headerLength = genhtb.parseHtbHeader(htb)
+	except ValueError, err:
+		problems.append(str(err))
+		appId, version, secret, headerLength = None, None, None, None
+	for name, value, expected in [
+		('application ID', appId, manifest.appId),
+		('version', version, manifest.getBase36Version()),
+		('secret', secret, manifest.secret)]:
+		if value is not None and value != str(expected):
+			problems.append('hashtable %s is %s, manifest says %s' % (name, value, expected))
+
+	exe = open(path.join(appPath, 'Bin', appName + '.exe'), 'rb')
+	try:
+		h = _checkPages(exe, buffer(htb, headerLength) if headerLength else None, problems)
+	finally:
+		exe.close()
+
+	if files != ['/Bin/' + appName + '.exe', '/Info/manifest.xml']:
+		problems.append('signature.xml lists files %s' % ', '.join(files))
+	if devcert is not None and certificates[:1] != [devcert]:
+		problems.append('signature.xml does not contain the development certificate')
+	if cacert is not None and certificates[1:2] != [cacert]:
+		problems.append('signature.xml does not contain the CA certificate')
+	if devcert is None and not certificates:
+		problems.append('signature.xml contains no certificates')
+		return problems
+	key = signing.certificateKey(devcert or certificates[0])
+	h.update(manifestData)
+	if not signing.verifySignature(key, h.digest(), packageSignature):
+		problems.append('package signature does not match the executable and manifest')
+	if not signing.verifySignature(key, hashlib.sha1(htb).digest(), appSignature):
+		problems.append('application signature does not match the hashtable')
+	return problems
+
+# the certificates used by verifyBatch, inherited by its workers
+_batch = None
+
+def _verifyJob(job):
+	appPath, appName = job
+	start = time.time()
+	try:
+		devcert, cacert = _batch
+		problems = verifyPackage(appPath, appName, devcert, cacert)
+	except Exception, err:
+		problems = [str(err) or err.__class__.__name__]
+	return appPath, time.time() - start, problems
+
+def verifyBatch(jobs, devcert = None, cacert = None, processes = None):
+	"""Verify the applications given as tuples (app_path, app_name),
+	where app_name may be None, using processes workers (by default,
+	one per core). Yield tuple (app_path, seconds, list of problems)
+	for each application, in the order of jobs, as soon as it is done."""
+	global _batch
+	_batch = (devcert, cacert)
+	if processes == 1 or len(jobs) < 2:
+		for job in jobs:
+			yield _verifyJob(job)
+		return
+	pool = multiprocessing.Pool(processes)
+	try:
+		for res in pool.imap(_verifyJob, jobs, 4):
+			yield res
+	finally:
+		pool.close()
+		pool.join()
+
+def usage():
+	print '''{0} checks if the hashtable and signature files of bada applications
+match their executables and manifests, and if they are signed with
+the development certificate.
+
+Example:
+ {0} -p /opt/badasdk/crypto 93bt1p123e 93bt1p456f:OtherApp
+
+Usage:
+ {0} [-p path] [-d dev_cert] [-c ca_cert] [-j n] [-q] app_path[:app_name]...
+ {0} -h|--help
+
+If app_name is not given, it is taken from the only executable
+in {{app_path}}/Bin. {0} reads the following files:
+ - {{app_path}}/Bin/{{app_name}}.exe  - the application executable file
+ - {{app_path}}/Info/{{app_name}}.htb - the hashtable file
+ - {{app_path}}/Info/manifest.xml   - the manifest file
+ - {{app_path}}/signature.xml       - the signature file
+
+Options:
+ -p,  --crypto-path=path Specify path where {0} will search for
+                         default certificate file names.
+ -d,  --devcert-file=fn  Specify bada development certificate file name.
+                         If neither this nor -p is given, the signatures
+                         are checked against the certificate they come with.
+ -c,  --cacert-file=fn   Specify bada development CA certificate file name.
+ -j,  --jobs=n           Verify up to n applications at the same time
+                         (default: number of cores).
+ -q,  --quiet            Only print the applications which failed.'''.format(sys.argv[0])
+
+def main():
+	try:
+		opts, args = getopt.getopt(
+			sys.argv[1:],
+			"hp:d:c:j:q",
+			["help", "crypto-path=", "devcert-file=", "cacert-file=", "jobs=", "quiet"])
+	except getopt.GetoptError, err:
+		sys.stderr.write('%s: %s\n' % (str(err), sys.argv[0]))
+		sys.stderr.write('invoke %s -h to get usage information\n' % sys.argv[0])
+		sys.exit(2)
+
+	cryptoPath = None
+	devCertFile = None
+	caCertFile = None
+	processes = None
+	quiet = False
+	for o, a in opts:
+		if o in ('-h', '--help'):
+			usage()
+			sys.exit()
+		elif o in ('-p', '--crypto-path'):
+			cryptoPath = a
+		elif o in ('-d', '--devcert-file'):
+			devCertFile = a
+		elif o in ('-c', '--cacert-file'):
+			caCertFile = a
+		elif o in ('-j', '--jobs'):
+			try:
+				processes = max(1, int(a))
+			except ValueError:
+				sys.stderr.write('%s: invalid number of jobs: %s\n' % (sys.argv[0], a))
+				sys.stderr.write('invoke %s -h to get usage information\n' % sys.argv[0])
+				sys.exit(2)
+		elif o in ('-q', '--quiet'):
+			quiet = True
+		else:
+			assert False, 'unhandled option'
+	if not cryptoPath is None:
+		if not devCertFile:
+			devCertFile = path.join(cryptoPath, 'badaDev.cer')
+		if not caCertFile:
+			caCertFile = path.join(cryptoPath, 'badaCA.cer')
+	if not args:
+		sys.stderr.write("%s: no applications to verify\n" % sys.argv[0])
+		sys.exit(2)
+	jobs = []
+	for a in args:
+		appPath, sep, appName = a.partition(':')
+		jobs.append((appPath, appName or None))
+	try:
+		devcert = signing.stripCertificate(devCertFile) if devCertFile else None
+		cacert = signing.stripCertificate(caCertFile) if caCertFile else None
+	except IOError, err:
+		sys.stderr.write('%s: %s\n' % (sys.argv[0], str(err)))
+		sys.exit(1)
+
+	start = time.time()
+	failed = 0
+	for appPath, t, problems in verifyBatch(jobs, devcert, cacert, processes):
+		if problems:
+			failed += 1
+			for p in problems:
+				print '%s: %s' % (appPath, p)
+		elif not quiet:
+			print '%s: OK (%.3f s)' % (appPath, t)
+		sys.stdout.flush()
+	if not quiet:
+		print '%d OK, %d failed in %.2f s' % (len(jobs) - failed, failed, time.time() - start)
+	sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,81 @@
+#!/usr/bin/python
+
+# test_daemon - checks of the requests the broker daemon accepts
+# Copyright (C) 2012 Adrian Matoga
+#
+# bali-sdk is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# bali-sdk is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with bali-sdk.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import json
+import socket
+import threading
+import unittest
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(root, 'scripts'))
+sys.path.insert(0, os.path.join(root, 'bench'))
+import broker
+import emulator
+
+class DaemonRequestTest(unittest.TestCase):
+	"""Sends requests to a daemon connected to the emulator, the way
+	a client does over the Unix socket, and checks the replies."""
+	def setUp(self):
+		self.emu = emulator.Emulator()
+		self.emu.start()
+		def connect():
+			return broker.SamsungWave(self.emu.port, self.emu.debugPort, stats = broker.Stats())
+		self.daemon = broker.BrokerDaemon(connect, None)
+
+	def tearDown(self):
+		if self.daemon._wave:
+			self.daemon._wave.close()
+		self.emu.stop()
+
+	def request(self, **request):
+		"""Return the messages the daemon sends in reply to request."""
+		request.setdefault('cwd', os.getcwd())
+		client, server = socket.socketpair()
+		client.sendall(json.dumps(request) + '\n')
+		handler = threading.Thread(target = self.daemon._handle, args = (server,))
+		handler.start()
+		replies = client.makefile('r')
+		messages = []
+		# the last message carries the exit code
+		while not messages or not 'exit' in messages[-1]:
+			messages.append(json.loads(replies.readline()))
+		handler.join()
+		client.close()
+		server.close()
+		return messages
+
+	def testWindowIsClamped(self):
+		replies = self.request(args = ['ls', '/'], window = 0)
+		self.assertEqual(replies[-1]['exit'], 0)
+		self.assertEqual(self.daemon._wave.window, 1)
+		replies = self.request(args = ['ls', '/'], window = 1000, chunkSize = -5, retries = -1)
+		self.assertEqual(replies[-1]['exit'], 0)
+		self.assertEqual(self.daemon._wave.window, broker.SamsungWave._RESPONSE_CAPACITY)
+		self.assertEqual(self.daemon._wave.chunkSize, 1)
+
+	def testStringChunkSizeIsRejected(self):
+		replies = self.request(args = ['ls', '/'], chunkSize = '4096')
+		self.assertEqual(replies[-1]['exit'], 2)
+		self.assertTrue('chunkSize' in replies[0]['out'])
+		# nothing has been sent to the phone
+		self.assertEqual(self.daemon._wave, None)
+
+if __name__ == '__main__':
+	unittest.main()